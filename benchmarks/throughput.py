@@ -0,0 +1,367 @@
+"""
+End-to-end throughput benchmark of the orchestrator hot path.
+
+Every scenario starts a fresh orchestrator on SQLite in a temporary directory,
+seeds its study with a number of finished trials and then lets a number of
+simulated workers run a trivial objective through the real `RestStorage`. Each
+simulated worker registers and pings like a real node and runs the executor
+trial loop in its own process.
+
+Reports trials per second and the p50/p99 latency per `/optuna/*` operation as
+seen by the executors, for every combination of study size and worker count.
+
+    python -m benchmarks.throughput --workers 1 4 16 --study-sizes 0 1000
+"""
+
+import argparse
+import functools
+import json
+import multiprocessing
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import optuna
+
+from executor.main import ask_server_side, run_leased_trials, run_trials
+from executor.rest_pruner import RestPruner
+from executor.rest_storage import RestStorage
+from executor.timeline import Timeline
+from shared.models.timeline import percentile
+
+STUDY_NAME = "benchmark"
+PING_INTERVAL_SECONDS = 1
+
+
+@dataclass
+class Scenario:
+    study_size: int
+    workers: int
+    trials_per_worker: int
+    server_ask: bool
+    lease_size: int
+    seed: int
+
+
+@dataclass
+class WorkerResult:
+    trials: int
+    started_at: float
+    finished_at: float
+    round_trips: list[tuple[str, float]]
+
+
+@dataclass
+class OperationLatency:
+    count: int
+    p50_ms: float
+    p99_ms: float
+
+
+@dataclass
+class ScenarioResult:
+    scenario: Scenario
+    trials: int
+    seconds: float
+    trials_per_second: float
+    operations: dict[str, OperationLatency]
+
+
+class RecordingStorage(RestStorage):
+    """Keeps every round trip, the executor hands them to the trial timelines"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.recorded = []
+
+    def take_round_trips(self):
+        round_trips = super().take_round_trips()
+        self.recorded.extend(round_trips)
+        return round_trips
+
+
+def objective(trial: optuna.Trial) -> float:
+    x = trial.suggest_float("x", -10, 10)
+    return x**2
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _post(url: str, body: dict) -> None:
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(body).encode(),
+        headers={"content-type": "application/json"},
+        method="POST",
+    )
+    with urllib.request.urlopen(request) as response:
+        response.read()
+
+
+def _ping_until(url: str, node_id: str, stop: threading.Event) -> None:
+    while not stop.wait(PING_INTERVAL_SECONDS):
+        _post(
+            f"{url}/ping",
+            {"node_id": node_id, "current_trial_id": None, "status": "busy"},
+        )
+
+
+def run_worker(url: str, index: int, scenario: Scenario) -> WorkerResult:
+    """A simulated node with a single slot running one resident executor"""
+    node_id = f"benchmark-{index}"
+    _post(
+        f"{url}/register",
+        {
+            "node_id": node_id,
+            "capabilities": {"cpu_count": 1, "memory_gb": 1.0, "hostname": node_id},
+        },
+    )
+    stop = threading.Event()
+    pinger = threading.Thread(target=_ping_until, args=(url, node_id, stop))
+    pinger.start()
+
+    storage = RecordingStorage(url, node_id=node_id)
+    try:
+        study = optuna.load_study(
+            study_name=STUDY_NAME,
+            storage=storage,
+            sampler=optuna.samplers.TPESampler(seed=scenario.seed + index),
+            pruner=RestPruner(storage),
+        )
+        ask = (
+            functools.partial(ask_server_side, study, storage)
+            if scenario.server_ask
+            else study.ask
+        )
+        storage.take_round_trips()
+        started_at = time.perf_counter()
+        if scenario.lease_size > 1:
+            trials = run_leased_trials(
+                study,
+                storage,
+                objective,
+                lease_size=scenario.lease_size,
+                lease_seconds=300,
+                n_trials=scenario.trials_per_worker,
+                timeout=None,
+                process_timeline=Timeline(),
+            )
+        else:
+            trials = run_trials(
+                study,
+                storage,
+                objective,
+                ask,
+                n_trials=scenario.trials_per_worker,
+                timeout=None,
+                process_timeline=Timeline(),
+            )
+        storage.flush()
+        finished_at = time.perf_counter()
+    finally:
+        storage.close()
+        stop.set()
+        pinger.join()
+
+    return WorkerResult(
+        trials=trials,
+        started_at=started_at,
+        finished_at=finished_at,
+        round_trips=[(trip.operation, trip.seconds) for trip in storage.recorded],
+    )
+
+
+def seed_study(db_url: str, study_size: int, seed: int) -> None:
+    study = optuna.create_study(
+        study_name=STUDY_NAME, storage=db_url, direction="minimize"
+    )
+    rng = random.Random(seed)
+    distribution = optuna.distributions.FloatDistribution(-10, 10)
+    trials = []
+    for _ in range(study_size):
+        x = rng.uniform(-10, 10)
+        trials.append(
+            optuna.trial.create_trial(
+                params={"x": x}, distributions={"x": distribution}, value=x**2
+            )
+        )
+    study.add_trials(trials)
+
+
+def wait_until_ready(url: str, process: subprocess.Popen, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("The orchestrator exited during startup")
+        try:
+            with urllib.request.urlopen(f"{url}/metrics") as response:
+                response.read()
+                return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    raise TimeoutError(f"The orchestrator did not start within {timeout} seconds")
+
+
+def summarize(scenario: Scenario, results: list[WorkerResult]) -> ScenarioResult:
+    trials = sum(result.trials for result in results)
+    # The clocks of the worker processes are comparable, perf_counter is system wide
+    seconds = max(result.finished_at for result in results) - min(
+        result.started_at for result in results
+    )
+    latencies: dict[str, list[float]] = {}
+    for result in results:
+        for operation, elapsed in result.round_trips:
+            latencies.setdefault(operation, []).append(elapsed)
+
+    operations = {}
+    for operation, samples in sorted(latencies.items()):
+        samples.sort()
+        operations[operation] = OperationLatency(
+            count=len(samples),
+            p50_ms=percentile(samples, 0.5) * 1000,
+            p99_ms=percentile(samples, 0.99) * 1000,
+        )
+    return ScenarioResult(
+        scenario=scenario,
+        trials=trials,
+        seconds=seconds,
+        trials_per_second=trials / seconds if seconds > 0 else 0.0,
+        operations=operations,
+    )
+
+
+def run_scenario(scenario: Scenario, startup_timeout: float) -> ScenarioResult:
+    with tempfile.TemporaryDirectory(prefix="kodu-benchmark-") as directory:
+        data_dir = Path(directory)
+        db_url = f"sqlite:///{data_dir.joinpath('optuna.db').as_posix()}"
+        seed_study(db_url, scenario.study_size, scenario.seed)
+
+        port = _free_port()
+        url = f"http://127.0.0.1:{port}"
+        config_file = data_dir.joinpath("config.yaml")
+        config_file.write_text(
+            "\n".join(
+                [
+                    "host: 127.0.0.1",
+                    f"port: {port}",
+                    f"db_url: {db_url}",
+                    f"data_dir: {data_dir.as_posix()}",
+                    f"ping_interval_seconds: {PING_INTERVAL_SECONDS}",
+                ]
+            )
+        )
+        with data_dir.joinpath("orchestrator.log").open("w") as log:
+            orchestrator = subprocess.Popen(
+                [sys.executable, "-m", "dobu_manager.main", "-c", str(config_file)],
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+            try:
+                wait_until_ready(url, orchestrator, startup_timeout)
+                with ProcessPoolExecutor(
+                    max_workers=scenario.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                ) as pool:
+                    futures = [
+                        pool.submit(run_worker, url, index, scenario)
+                        for index in range(scenario.workers)
+                    ]
+                    results = [future.result() for future in futures]
+            finally:
+                orchestrator.terminate()
+                orchestrator.wait()
+    return summarize(scenario, results)
+
+
+def print_result(result: ScenarioResult) -> None:
+    scenario = result.scenario
+    print(
+        f"\nstudy size {scenario.study_size}, {scenario.workers} worker(s), "
+        f"{'server' if scenario.server_ask else 'client'} side sampling, "
+        f"lease size {scenario.lease_size}: "
+        f"{result.trials} trials in {result.seconds:.2f}s, "
+        f"{result.trials_per_second:.1f} trials/s"
+    )
+    print(f"  {'operation':<45} {'count':>7} {'p50 ms':>9} {'p99 ms':>9}")
+    for operation, latency in result.operations.items():
+        print(
+            f"  {operation:<45} {latency.count:>7} "
+            f"{latency.p50_ms:>9.2f} {latency.p99_ms:>9.2f}"
+        )
+
+
+def cli_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[1, 4],
+        help="The numbers of simulated workers to benchmark",
+    )
+    parser.add_argument(
+        "--study-sizes",
+        type=int,
+        nargs="+",
+        default=[0, 1000],
+        help="The numbers of finished trials to seed the study with",
+    )
+    parser.add_argument("--trials-per-worker", type=int, default=50)
+    parser.add_argument(
+        "--server-ask",
+        action="store_true",
+        help="Let the orchestrator sample the parameters of every trial",
+    )
+    parser.add_argument(
+        "--lease-size",
+        type=int,
+        default=1,
+        help="Lease this many trials per request and tell them together",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument(
+        "--output", type=Path, default=None, help="Also write the results as JSON"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = cli_parser()
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    results = []
+    for study_size in args.study_sizes:
+        for workers in args.workers:
+            scenario = Scenario(
+                study_size=study_size,
+                workers=workers,
+                trials_per_worker=args.trials_per_worker,
+                server_ask=args.server_ask,
+                lease_size=args.lease_size,
+                seed=args.seed,
+            )
+            result = run_scenario(scenario, args.startup_timeout)
+            print_result(result)
+            results.append(result)
+
+    if args.output is not None:
+        args.output.write_text(
+            json.dumps([asdict(result) for result in results], indent=2)
+        )
+
+
+if __name__ == "__main__":
+    main()
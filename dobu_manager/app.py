@@ -1,5 +1,25 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 
+from dobu_manager import metrics
+from dobu_manager.services.node_sweeper import run_sweeper
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Runs the background tasks of the orchestrator while the app serves"""
+    tasks = [
+        asyncio.create_task(metrics.probe_event_loop_lag()),
+        asyncio.create_task(run_sweeper()),
+    ]
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-app: FastAPI = FastAPI()
 
+app: FastAPI = FastAPI(lifespan=lifespan)
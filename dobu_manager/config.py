@@ -16,6 +16,14 @@ class OrchestratorConfig:
             self.ping_interval_seconds = 30
             self.data_dir = pathlib.Path("./data").absolute()
             self.db_url = "sqlite:///data/optuna.db"
+            self.db_pool_size = 10
+            self.db_max_overflow = 20
+            self.scheduler = "fair_share"
+            self.workers = 1
+            self.missed_pings_before_eviction = 3
+            self.orphaned_trials = "fail"
+            self.max_requeues = 3
+            self.max_timelines_per_study = 10000
         else:
             with path.open("r") as file:
                 config = yaml.safe_load(file)
@@ -27,6 +35,18 @@ class OrchestratorConfig:
                 ).absolute()
 
                 self.db_url = config["db_url"]
+                self.db_pool_size = config.get("db_pool_size", 10)
+                self.db_max_overflow = config.get("db_max_overflow", 20)
+                self.scheduler = config.get("scheduler", "fair_share")
+                self.workers = config.get("workers", 1)
+                self.missed_pings_before_eviction = config.get(
+                    "missed_pings_before_eviction", 3
+                )
+                self.orphaned_trials = config.get("orphaned_trials", "fail")
+                self.max_requeues = config.get("max_requeues", 3)
+                self.max_timelines_per_study = config.get(
+                    "max_timelines_per_study", 10000
+                )
 
         self.data_dir.mkdir(parents=True, exist_ok=True)
         OrchestratorConfig._active = self
@@ -35,7 +55,13 @@ class OrchestratorConfig:
         return (
             f"OrchestratorConfig(host={self.host}, port={self.port}, "
             f"ping_interval_seconds={self.ping_interval_seconds}, "
-            f"db_url={self.db_url})"
+            f"db_url={self.db_url}, db_pool_size={self.db_pool_size}, "
+            f"db_max_overflow={self.db_max_overflow}, scheduler={self.scheduler}, "
+            f"workers={self.workers}, "
+            f"missed_pings_before_eviction={self.missed_pings_before_eviction}, "
+            f"orphaned_trials={self.orphaned_trials}, "
+            f"max_requeues={self.max_requeues}, "
+            f"max_timelines_per_study={self.max_timelines_per_study})"
         )
 
     def __repr__(self):
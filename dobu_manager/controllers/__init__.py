@@ -1,3 +1,4 @@
+from .metrics_controller import *  # noqa: F403
 from .node_controller import *  # noqa: F403
 from .optuna_controller import *  # noqa: F403
 from .study_controller import *  # noqa: F403
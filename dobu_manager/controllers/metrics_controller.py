@@ -0,0 +1,103 @@
+import time
+
+from fastapi.responses import PlainTextResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from dobu_manager import metrics
+from dobu_manager.app import app
+from dobu_manager.config import OrchestratorConfig
+from dobu_manager.repositories.node_repository import find_all_nodes
+
+
+class RequestMetricsMiddleware:
+    """
+    Counts and times every HTTP request. A plain ASGI middleware that only wraps
+    `send` to see the status, no extra task or body stream per request.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = "500"
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Label by route template so path parameters do not explode the series
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            metrics.http_requests.inc(scope["method"], route, status)
+            metrics.http_request_duration.observe(
+                time.perf_counter() - start, scope["method"], route
+            )
+
+
+app.add_middleware(RequestMetricsMiddleware)
+
+
+def _collect_active_nodes():
+    yield (), float(len(find_all_nodes()))
+
+
+def _ping_ages() -> list[float]:
+    now = time.time()
+    return [now - node.last_ping for node in find_all_nodes()]
+
+
+def _collect_max_ping_age():
+    yield (), max(_ping_ages(), default=0.0)
+
+
+def _collect_min_ping_age():
+    yield (), min(_ping_ages(), default=0.0)
+
+
+def _collect_stale_nodes():
+    # A node that missed a ping, the sweeper evicts it after a few more
+    stale_after = 2 * OrchestratorConfig.get().ping_interval_seconds
+    yield (), float(sum(age > stale_after for age in _ping_ages()))
+
+
+metrics.registry.register(
+    metrics.Gauge("kodu_active_nodes", "Registered worker nodes", _collect_active_nodes)
+)
+metrics.registry.register(
+    metrics.Gauge(
+        "kodu_node_max_ping_age_seconds",
+        "Seconds since the last ping of the most lagging node",
+        _collect_max_ping_age,
+    )
+)
+metrics.registry.register(
+    metrics.Gauge(
+        "kodu_node_min_ping_age_seconds",
+        "Seconds since the last ping of the most recently seen node",
+        _collect_min_ping_age,
+    )
+)
+metrics.registry.register(
+    metrics.Gauge(
+        "kodu_stale_nodes",
+        "Registered nodes that missed at least one ping",
+        _collect_stale_nodes,
+    )
+)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics() -> PlainTextResponse:
+    """Prometheus text exposition of the orchestrator metrics"""
+    return PlainTextResponse(
+        metrics.registry.render(), media_type="text/plain; version=0.0.4"
+    )
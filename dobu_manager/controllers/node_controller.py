@@ -3,6 +3,10 @@ from loguru import logger
 
 from dobu_manager.app import app
 from dobu_manager.config import OrchestratorConfig
+from dobu_manager.services.node_command_service import (
+    commands_for_ping,
+    queue_command,
+)
 from dobu_manager.services.node_service import (
     node_exists,
     register_node,
@@ -10,6 +14,7 @@ from dobu_manager.services.node_service import (
     update_node_ping,
 )
 from shared.models.node import (
+    NodeCommand,
     NodePing,
     NodeRegistration,
     NodeRegistrationSuccess,
@@ -18,7 +23,7 @@ from shared.models.node import (
 
 
 @app.post("/register")
-async def handle_register_node(
+def handle_register_node(
     node: NodeRegistration, config: OrchestratorConfig = Depends(OrchestratorConfig.get)
 ) -> NodeRegistrationSuccess:
     """Register a new worker node"""
@@ -34,16 +39,26 @@ async def handle_register_node(
 
 
 @app.post("/ping")
-async def handle_node_ping(ping: NodePing) -> PingResult:
+def handle_node_ping(ping: NodePing) -> PingResult:
+    # A plain function runs in the threadpool, a busy database never blocks the loop
     node_id = ping.node_id
     if not node_exists(node_id):
         raise HTTPException(status_code=404, detail="Node not registered")
     update_node_ping(ping)
+    return PingResult(status="ok", commands=commands_for_ping(ping))
+
+
+@app.post("/node/{node_id}/command")
+def handle_queue_node_command(node_id: str, command: NodeCommand) -> PingResult:
+    """Queue a command for the node, it is handed out with the next ping"""
+    if not node_exists(node_id):
+        raise HTTPException(status_code=404, detail="Node not registered")
+    queue_command(node_id, command)
     return PingResult(status="ok")
 
 
 @app.delete("/node/{node_id}")
-async def handle_delete_node(node_id: str) -> PingResult:
+def handle_delete_node(node_id: str) -> PingResult:
     if not node_exists(node_id):
         raise HTTPException(status_code=404, detail="Node not registered")
     remove_node(node_id)
@@ -1,32 +1,46 @@
 import optuna
 import optuna.distributions
-from fastapi import HTTPException
+from fastapi import Header, HTTPException
 from optuna.storages import BaseStorage
 from optuna.trial import TrialState
 
+from dobu_manager import metrics
 from dobu_manager.app import app
-from dobu_manager.config import OrchestratorConfig
+from dobu_manager.repositories.optuna_repository import (
+    get_storage,
+    get_trials_after,
+)
+from dobu_manager.services import node_service, optuna_service, timeline_service
+from shared.models.node import NODE_ID_HEADER
 from shared.models.optuna import (
+    OptunaAsk,
     OptunaGetAllTrials,
+    OptunaLease,
+    OptunaLeasedTrials,
     OptunaRequestStudyFromName,
+    OptunaSetIntermediateValue,
     OptunaSetParam,
     OptunaSetState,
     OptunaSetValue,
     OptunaSetValueResponse,
+    OptunaShouldPrune,
     OptunaStudyDirection,
     OptunaStudyIdFromName,
     OptunaStudyNameFromId,
     OptunaStudySummary,
+    OptunaTell,
+    OptunaTellResponse,
     OptunaTrial,
     OptunaTrialCreation,
+    OptunaWriteBatch,
+    OptunaWriteBatchResponse,
 )
 from shared.models.study import StudyDirection
+from shared.models.timeline import StudyTimelineSummary
 
 
 def storage() -> BaseStorage:
-    config = OrchestratorConfig.get()
-    storage = optuna.storages.RDBStorage(config.db_url)
-    return storage
+    return get_storage()
 
 
 @app.put("/optuna/study")
@@ -43,18 +57,37 @@ def get_study_name_from_id(study_id: int) -> OptunaStudyNameFromId:
 
 @app.get("/optuna/study/{study_id}/trials")
 def get_all_trails_from_study(study_id: int) -> OptunaGetAllTrials:
-    trials = storage().get_all_trials(study_id)
-    return OptunaGetAllTrials(
-        trials=[
-            OptunaTrial.from_frozen(
-                trial_id=storage().get_trial_id_from_study_id_trial_number(
-                    study_id=study_id, trial_number=trial.number
-                ),
-                trial=trial,
-            )
-            for trial in trials
-        ]
-    )
+    with metrics.db_duration.time("get_all_trials"):
+        trials = storage().get_all_trials(study_id, deepcopy=False)
+    # The frozen trials already carry their id, no need to look it up per trial
+    with metrics.serialization_duration.time("get_all_trials"):
+        return OptunaGetAllTrials(
+            trials=[
+                OptunaTrial.from_frozen(trial_id=trial._trial_id, trial=trial)
+                for trial in trials
+            ]
+        )
+
+
+@app.get("/optuna/study/{study_id}/trials/changes")
+def get_trial_changes_from_study(
+    study_id: int, after_trial_id: int
+) -> OptunaGetAllTrials:
+    """
+    Return the trials of a study whose id is larger than `after_trial_id`.
+
+    Finished trials never change, so a client that caches the finished prefix
+    of a study only needs the trials after it to be up to date.
+    """
+    with metrics.db_duration.time("get_trial_changes"):
+        trials = get_trials_after(study_id, after_trial_id)
+    with metrics.serialization_duration.time("get_trial_changes"):
+        return OptunaGetAllTrials(
+            trials=[
+                OptunaTrial.from_frozen(trial_id=trial._trial_id, trial=trial)
+                for trial in trials
+            ]
+        )
 
 
 direction_mapper: dict[optuna.study.StudyDirection, StudyDirection] = {
@@ -72,23 +105,127 @@ def get_study_direction(study_id: int) -> OptunaStudyDirection:
 
 
 @app.post("/optuna/study/{study_id}")
-def create_new_trial(study_id: int) -> OptunaTrialCreation:
-    trial_id = storage().create_new_trial(study_id, None)
+def create_new_trial(
+    study_id: int, node_id: str | None = Header(None, alias=NODE_ID_HEADER)
+) -> OptunaTrialCreation:
+    try:
+        optuna_service.reserve_trials(study_id, 1)
+    except optuna_service.TrialBudgetExhausted as e:
+        raise HTTPException(409, detail=str(e))
+    with metrics.db_duration.time("create_new_trial"):
+        trial_id = storage().create_new_trial(study_id, None)
+    metrics.trials_created.inc(str(study_id))
+    if node_id is not None:
+        node_service.record_trial_owner(node_id, trial_id)
     return OptunaTrialCreation(trial_id=trial_id)
 
 
+def _parse_distributions(
+    distributions: dict[str, str] | None,
+) -> dict[str, optuna.distributions.BaseDistribution] | None:
+    if distributions is None:
+        return None
+    return {
+        name: optuna.distributions.json_to_distribution(distribution)
+        for name, distribution in distributions.items()
+    }
+
+
+@app.post("/optuna/study/{study_id}/ask")
+def ask_trial(
+    study_id: int,
+    data: OptunaAsk,
+    node_id: str | None = Header(None, alias=NODE_ID_HEADER),
+) -> OptunaTrial:
+    distributions = _parse_distributions(data.distributions)
+    try:
+        with metrics.db_duration.time("ask"):
+            trial = optuna_service.ask(study_id, distributions)
+    except optuna_service.TrialBudgetExhausted as e:
+        raise HTTPException(409, detail=str(e))
+    metrics.trials_created.inc(str(study_id))
+    if node_id is not None:
+        node_service.record_trial_owner(node_id, trial._trial_id)
+    with metrics.serialization_duration.time("ask"):
+        return OptunaTrial.from_frozen(trial_id=trial._trial_id, trial=trial)
+
+
+@app.post("/optuna/study/{study_id}/lease")
+def lease_trials(
+    study_id: int,
+    data: OptunaLease,
+    node_id: str | None = Header(None, alias=NODE_ID_HEADER),
+) -> OptunaLeasedTrials:
+    """
+    Ask a number of trials at once, to be told together through `/tell`. Fewer
+    are handed out when the trial budget of the study runs out, none is a 409.
+    """
+    distributions = _parse_distributions(data.distributions)
+    try:
+        with metrics.db_duration.time("lease"):
+            trials, expires_at = optuna_service.lease(
+                study_id, data.count, data.lease_seconds, distributions
+            )
+    except optuna_service.TrialBudgetExhausted as e:
+        raise HTTPException(409, detail=str(e))
+    metrics.trials_created.inc(str(study_id), amount=len(trials))
+    if node_id is not None:
+        for trial in trials:
+            node_service.record_trial_owner(node_id, trial._trial_id)
+    with metrics.serialization_duration.time("lease"):
+        return OptunaLeasedTrials(
+            trials=[
+                OptunaTrial.from_frozen(trial_id=trial._trial_id, trial=trial)
+                for trial in trials
+            ],
+            expires_at=expires_at,
+        )
+
+
+@app.post("/optuna/study/{study_id}/tell")
+def tell_trials(study_id: int, data: OptunaTell) -> OptunaTellResponse:
+    try:
+        with metrics.db_duration.time("tell"):
+            did_update = optuna_service.tell(study_id, data.results)
+    except optuna_service.TrialNotInStudy as e:
+        raise HTTPException(400, detail=str(e))
+    return OptunaTellResponse(did_update=did_update)
+
+
+@app.get("/optuna/study/{study_id}/trial/{trial_id}/should-prune")
+def should_prune_trial(study_id: int, trial_id: int) -> OptunaShouldPrune:
+    try:
+        return OptunaShouldPrune(
+            should_prune=optuna_service.should_prune(study_id, trial_id)
+        )
+    except optuna_service.TrialNotInStudy as e:
+        raise HTTPException(400, detail=str(e))
+
+
+@app.get("/optuna/study/{study_id}/timeline")
+def get_study_timeline(study_id: int) -> StudyTimelineSummary:
+    """Where the traced trials of a study spent their time, per phase"""
+    return timeline_service.summarize_study(study_id)
+
+
 @app.get("/optuna/trial/{trial_id}")
 def get_trial(trial_id: int) -> OptunaTrial:
-    trial = storage().get_trial(trial_id)
-    return OptunaTrial.from_frozen(trial_id=trial_id, trial=trial)
+    with metrics.db_duration.time("get_trial"):
+        trial = storage().get_trial(trial_id)
+    with metrics.serialization_duration.time("get_trial"):
+        return OptunaTrial.from_frozen(trial_id=trial_id, trial=trial)
 
 
 @app.post("/optuna/trial/{trial_id}")
 def set_trial_values(trial_id: int, data: OptunaSetValue) -> OptunaSetValueResponse:
     try:
-        result = storage().set_trial_state_values(
-            trial_id, state=data.state, values=data.value
-        )
+        with metrics.db_duration.time("set_trial_state_values"):
+            result = storage().set_trial_state_values(
+                trial_id, state=data.state, values=data.value
+            )
+        if result and data.state.is_finished():
+            optuna_service.record_finished_trial(trial_id, data.state)
+            node_service.release_trial(trial_id)
         return OptunaSetValueResponse(did_update=result)
     except RuntimeError:
         raise HTTPException(400, "trial already completed")
@@ -111,6 +248,23 @@ def set_trial_param(trial_id: int, data: OptunaSetParam):
     return {"ok": True}
 
 
+@app.post("/optuna/trial/{trial_id}/intermediate-value")
+def set_trial_intermediate_value(trial_id: int, data: OptunaSetIntermediateValue):
+    try:
+        storage().set_trial_intermediate_value(trial_id, data.step, data.value)
+    except RuntimeError:
+        raise HTTPException(400, "trial already completed")
+    return {"ok": True}
+
+
+@app.post("/optuna/trials/batch")
+def apply_trial_writes(
+    data: OptunaWriteBatch, node_id: str | None = Header(None, alias=NODE_ID_HEADER)
+) -> OptunaWriteBatchResponse:
+    with metrics.db_duration.time("apply_writes"):
+        return optuna_service.apply_writes(data.writes, node_id)
+
+
 @app.get("/optuna/study-summaries")
 def handle_get_all_study_summaries() -> list[OptunaStudySummary]:
     optuna.study.get_all_study_summaries(storage())
@@ -1,10 +1,17 @@
 from typing import Annotated
 
-from fastapi import File, Form, HTTPException, UploadFile
-from fastapi.responses import FileResponse
+from fastapi import File, Form, Header, HTTPException, Query, UploadFile
+from fastapi.responses import FileResponse, Response
 
 from dobu_manager.app import app
-from dobu_manager.services.codebase_service import KoduConfig, check_codebase
+from dobu_manager.services.codebase_job_service import (
+    CodebaseJob,
+    get_job,
+    run_validation,
+    submit_update,
+    submit_validation,
+)
+from dobu_manager.services.codebase_service import KoduConfig
 from dobu_manager.services.study_service import (
     activate_study,
     does_study_exists,
@@ -14,30 +21,67 @@ from dobu_manager.services.study_service import (
     insert_study,
     is_codebase_present,
     pause_study,
-    select_single_study,
+    rank_studies,
     store_codebase_zip,
+    update_study_scheduling,
+    wait_for_study,
+)
+from shared.models.study import (
+    CodeBaseStudy,
+    CreateStudy,
+    StudyCandidates,
+    StudyScheduling,
 )
-from dobu_manager.services.zip_service import extract_zip
-from shared.models.study import CodeBaseStudy, CreateStudy
 
 
-@app.post("/study/test")
-async def test_study(
-    study_name: Annotated[str, Form()], data: Annotated[UploadFile, File()]
-) -> KoduConfig:
+def _check_new_study_name(study_name: str) -> None:
     if not study_name.isalnum():
         raise HTTPException(400, detail="study name must be alpha numeric")
 
     if does_study_exists(study_name):
         raise HTTPException(400, detail="Study already exists")
 
-    zip_path = store_codebase_zip(study_name, data)
-    study_dir = extract_zip(zip_path)
-    code_base_state, config = check_codebase(study_dir)
-    if code_base_state != "ok":
-        raise HTTPException(400, detail=code_base_state)
 
-    return config
+@app.post("/study/test")
+async def test_study(
+    study_name: Annotated[str, Form()], data: Annotated[UploadFile, File()]
+) -> KoduConfig:
+    """Upload and validate a code base, `/study/test/job` does not wait for it"""
+    _check_new_study_name(study_name)
+    codebase_hash = await store_codebase_zip(data)
+    job = await run_validation(study_name, codebase_hash)
+    if job.status != "ok":
+        raise HTTPException(400, detail=job.detail)
+    return job.config
+
+
+@app.post("/study/test/job")
+async def test_study_in_background(
+    study_name: Annotated[str, Form()], data: Annotated[UploadFile, File()]
+) -> CodebaseJob:
+    """Upload a code base, poll `/study/jobs/{job_id}` for the validation result"""
+    _check_new_study_name(study_name)
+    codebase_hash = await store_codebase_zip(data)
+    return submit_validation(study_name, codebase_hash)
+
+
+@app.put("/study/{name}/codebase")
+async def handle_update_codebase(
+    name: str, data: Annotated[UploadFile, File()]
+) -> CodebaseJob:
+    if not does_study_exists(name):
+        raise HTTPException(404, detail="Study with name does not exists")
+
+    codebase_hash = await store_codebase_zip(data)
+    return submit_update(name, codebase_hash)
+
+
+@app.get("/study/jobs/{job_id}")
+async def handle_get_codebase_job(job_id: str) -> CodebaseJob:
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(404, detail="Job with id does not exists")
+    return job
 
 
 @app.post("/study")
@@ -55,13 +99,26 @@ async def handle_create_study(data: CreateStudy) -> CodeBaseStudy:
 
 
 @app.get("/study/request")
-async def handle_request_study() -> CodeBaseStudy:
-    selected = select_single_study()
+async def handle_request_study(
+    wait: Annotated[float, Query(ge=0, le=60)] = 0,
+    node_id: str | None = None,
+    slot: int | None = None,
+) -> CodeBaseStudy:
+    """Hand out a running study, waiting up to `wait` seconds for one"""
+    selected = await wait_for_study(wait, node_id=node_id, slot=slot)
     if selected is None:
         raise HTTPException(404, detail="No eligible studies available")
     return selected
 
 
+@app.get("/study/candidates")
+def handle_get_study_candidates(
+    node_id: str | None = None, limit: Annotated[int, Query(ge=1, le=20)] = 3
+) -> StudyCandidates:
+    """The studies the scheduler would most likely hand to the node next"""
+    return StudyCandidates(studies=rank_studies(node_id, slot=None)[:limit])
+
+
 @app.get("/study/{name}")
 async def handle_get_study_by_name(name: str) -> CodeBaseStudy:
     result = get_study_by_name(name)
@@ -89,11 +146,38 @@ async def handle_pause_study(name: str) -> CodeBaseStudy:
     return pause_study(name)
 
 
-@app.get("/study/{name}/download")
-async def download_study(name: str):
+@app.put("/study/{name}/scheduling")
+def handle_update_study_scheduling(
+    name: str, scheduling: StudyScheduling
+) -> CodeBaseStudy:
+    """Change the share of the fleet a study gets, busy slots move within a ping"""
+    # A plain function runs in the threadpool, rebalancing reads every node
     if not does_study_exists(name):
         raise HTTPException(404, detail="Study with name does not exists")
+    return update_study_scheduling(name, scheduling)
+
+
+@app.get("/study/{name}/download")
+async def download_study(
+    name: str, if_none_match: Annotated[str | None, Header()] = None
+):
+    study = get_study_by_name(name)
+    if study is None:
+        raise HTTPException(404, detail="Study with name does not exists")
+
+    headers = {}
+    if study.codebase_hash is not None:
+        etag = f'"{study.codebase_hash}"'
+        headers["ETag"] = etag
+        if if_none_match is not None and etag in (
+            tag.strip() for tag in if_none_match.split(",")
+        ):
+            return Response(status_code=304, headers=headers)
+
     zip_file = get_study_codebase_zip(name)
     return FileResponse(
-        zip_file, media_type="application/octet-stream", filename="data.zip"
+        zip_file,
+        media_type="application/octet-stream",
+        filename="data.zip",
+        headers=headers,
     )
@@ -1,14 +1,22 @@
 import argparse
+import os
 import pathlib
+import time
 
-import optuna
 import optuna_dashboard
 import uvicorn
+from fastapi import FastAPI
 from fastapi.middleware.wsgi import WSGIMiddleware
 from loguru import logger
 
 from dobu_manager.app import app
 from dobu_manager.config import OrchestratorConfig
+from dobu_manager.repositories.node_repository import touch_all_nodes
+from dobu_manager.repositories.optuna_repository import get_storage
+from dobu_manager.repositories.study_repository import StudyRepositoryConfig
+
+CONFIG_PATH_ENV = "KODU_ORCHESTRATOR_CONFIG"
+"""Hands the configuration file to the worker processes started by uvicorn"""
 
 
 class PrefixMiddleware:
@@ -29,19 +37,47 @@ class PrefixMiddleware:
             return [b"This route does not exist in the dashboard."]
 
 
-def main(config_path: str | None):
-    print("[DOBU] Lets get to work")
-    config = OrchestratorConfig(
+def _load_config() -> OrchestratorConfig:
+    config_path = os.environ.get(CONFIG_PATH_ENV)
+    return OrchestratorConfig(
         pathlib.Path(config_path) if config_path is not None else None
     )
-    logger.info(f"Starting server with the following settings: {config}")
-    storage = optuna.storages.RDBStorage(config.db_url)
-    dashboard = optuna_dashboard.wsgi(storage=storage)
+
+
+def create_app() -> FastAPI:
+    """Set up the app in the process that serves it"""
+    _load_config()
+    dashboard = optuna_dashboard.wsgi(storage=get_storage())
     # app.mount(
     #     "/dashboard/", (WSGIMiddleware(PrefixMiddleware(dashboard, "/dashboard")))
     # )
     app.mount("/", (WSGIMiddleware(dashboard)))
-    uvicorn.run(app, host=config.host, port=config.port)
+    return app
+
+
+def main(config_path: str | None):
+    print("[DOBU] Lets get to work")
+    if config_path is not None:
+        os.environ[CONFIG_PATH_ENV] = pathlib.Path(config_path).absolute().as_posix()
+    config = _load_config()
+    logger.info(f"Starting server with the following settings: {config}")
+
+    # Schemas and migrations run once, before the worker processes race for them
+    get_storage()
+    StudyRepositoryConfig.create(config)
+    # Nodes that outlived a restart keep pinging, the others are swept
+    touch_all_nodes(time.time())
+
+    if config.workers <= 1:
+        uvicorn.run(create_app(), host=config.host, port=config.port)
+    else:
+        uvicorn.run(
+            "dobu_manager.main:create_app",
+            factory=True,
+            workers=config.workers,
+            host=config.host,
+            port=config.port,
+        )
 
 
 if __name__ == "__main__":
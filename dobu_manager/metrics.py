@@ -0,0 +1,220 @@
+"""
+Minimal Prometheus metrics for the orchestrator.
+
+Recording is a lock, a dict lookup and an addition, cheap enough for every
+request. The text exposition format is only rendered when `/metrics` is scraped.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator
+
+type LabelValues = tuple[str, ...]
+
+EVENT_LOOP_PROBE_SECONDS = 0.5
+
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in values:
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}{labels} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # Per label set: the count per bucket (last one is +Inf), the sum
+        self._values: dict[LabelValues, tuple[list[int], list[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                label_values, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, *label_values: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = [
+                (label_values, list(counts), total[0])
+                for label_values, (counts, total) in self._values.items()
+            ]
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, counts, total in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                labels = _format_labels(
+                    (*self.labels, "le"), (*label_values, _format_value(bound))
+                )
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """A gauge whose samples are collected when the metrics are scraped"""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        collect: Callable[[], Iterable[tuple[LabelValues, float]]],
+        labels: tuple[str, ...] = (),
+    ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for label_values, value in self.collect():
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}{labels} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[Counter | Histogram | Gauge] = []
+
+    def register[M: Counter | Histogram | Gauge](self, metric: M) -> M:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = [line for metric in self._metrics for line in metric.render()]
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.register(
+    Counter(
+        "kodu_http_requests_total",
+        "HTTP requests handled per route",
+        ("method", "route", "status"),
+    )
+)
+http_request_duration = registry.register(
+    Histogram(
+        "kodu_http_request_duration_seconds",
+        "HTTP request latency per route",
+        ("method", "route"),
+    )
+)
+db_duration = registry.register(
+    Histogram(
+        "kodu_db_duration_seconds",
+        "Time spent in the optuna storage per operation",
+        ("operation",),
+    )
+)
+serialization_duration = registry.register(
+    Histogram(
+        "kodu_serialization_duration_seconds",
+        "Time spent converting between optuna objects and API models",
+        ("operation",),
+    )
+)
+trials_created = registry.register(
+    Counter("kodu_trials_created_total", "Trials created per study", ("study_id",))
+)
+trials_finished = registry.register(
+    Counter(
+        "kodu_trials_finished_total",
+        "Trials that reached a finished state per study",
+        ("study_id", "state"),
+    )
+)
+event_loop_lag = registry.register(
+    Histogram(
+        "kodu_event_loop_lag_seconds",
+        "How late the event loop woke up a sleeping probe task",
+    )
+)
+
+
+async def probe_event_loop_lag() -> None:
+    """Observe `event_loop_lag` until cancelled"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(EVENT_LOOP_PROBE_SECONDS)
+        event_loop_lag.observe(max(0.0, loop.time() - start - EVENT_LOOP_PROBE_SECONDS))
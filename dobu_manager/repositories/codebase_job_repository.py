@@ -0,0 +1,27 @@
+from dobu_manager.repositories.sqlite import connect
+
+# Jobs are polled through whichever orchestrator process takes the request
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS codebase_jobs (
+    id TEXT PRIMARY KEY,
+    document TEXT NOT NULL
+);
+"""
+
+_get_db = connect("jobs.db", _SCHEMA)
+
+
+def upsert_job(id: str, document: str) -> None:
+    _get_db().execute(
+        "INSERT OR REPLACE INTO codebase_jobs (id, document) VALUES (?, ?)",
+        (id, document),
+    )
+
+
+def find_job_by_id(id: str) -> str | None:
+    row = (
+        _get_db()
+        .execute("SELECT document FROM codebase_jobs WHERE id = ?", (id,))
+        .fetchone()
+    )
+    return row[0] if row is not None else None
@@ -0,0 +1,36 @@
+from dobu_manager.repositories.sqlite import connect
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS trial_leases (
+    trial_id INTEGER PRIMARY KEY,
+    study_id INTEGER NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS trial_leases_expires_at ON trial_leases (expires_at);
+"""
+
+_get_db = connect("leases.db", _SCHEMA)
+
+
+def insert_leases(trial_ids: list[int], study_id: int, expires_at: float) -> None:
+    _get_db().executemany(
+        "INSERT OR REPLACE INTO trial_leases (trial_id, study_id, expires_at)"
+        " VALUES (?, ?, ?)",
+        [(trial_id, study_id, expires_at) for trial_id in trial_ids],
+    )
+
+
+def delete_lease(trial_id: int) -> bool:
+    """Only one caller gets to end a lease, by telling or by letting it expire"""
+    cursor = _get_db().execute(
+        "DELETE FROM trial_leases WHERE trial_id = ?", (trial_id,)
+    )
+    return cursor.rowcount > 0
+
+
+def find_leases_expired_before(before: float) -> list[tuple[int, int]]:
+    """The trial and study ids of the expired leases, from the index"""
+    rows = _get_db().execute(
+        "SELECT trial_id, study_id FROM trial_leases WHERE expires_at < ?", (before,)
+    )
+    return list(rows)
@@ -1,25 +1,148 @@
-from shared.models.node import Node
+from typing import Callable
 
-active_nodes: dict[str, Node] = {}
+from dobu_manager.repositories.sqlite import connect
+from shared.models.node import Node, NodeCommand
+
+# Shared by all orchestrator processes, so every one of them sees the same nodes
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    id TEXT PRIMARY KEY,
+    last_ping REAL NOT NULL,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS nodes_last_ping ON nodes (last_ping);
+CREATE TABLE IF NOT EXISTS trial_owners (
+    trial_id INTEGER PRIMARY KEY,
+    node_id TEXT NOT NULL,
+    study_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS trial_owners_node ON trial_owners (node_id);
+CREATE TABLE IF NOT EXISTS node_commands (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    node_id TEXT NOT NULL,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS node_commands_node ON node_commands (node_id);
+"""
+
+_get_db = connect("nodes.db", _SCHEMA)
 
 
 def insert_node(node: Node) -> Node:
-    active_nodes[node.id] = node
+    _get_db().execute(
+        "INSERT OR REPLACE INTO nodes (id, last_ping, document) VALUES (?, ?, ?)",
+        (node.id, node.last_ping, node.model_dump_json()),
+    )
+    return node
 
 
 def update_node(node: Node) -> Node:
-    active_nodes[node.id] = node
+    _get_db().execute(
+        "UPDATE nodes SET last_ping = ?, document = ? WHERE id = ?",
+        (node.last_ping, node.model_dump_json(), node.id),
+    )
+    return node
+
+
+def modify_node(id: str, change: Callable[[Node], Node]) -> Node | None:
+    """Read, change and write back a node without racing other processes"""
+    db = _get_db()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        row = db.execute("SELECT document FROM nodes WHERE id = ?", (id,)).fetchone()
+        if row is None:
+            db.execute("COMMIT")
+            return None
+        node = update_node(change(Node.model_validate_json(row[0])))
+        db.execute("COMMIT")
+        return node
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
 
 
 def delete_node(id: str) -> bool:
-    if id in active_nodes:
-        active_nodes.pop(id)
-        return True
-    return False
+    cursor = _get_db().execute("DELETE FROM nodes WHERE id = ?", (id,))
+    _get_db().execute("DELETE FROM node_commands WHERE node_id = ?", (id,))
+    return cursor.rowcount > 0
+
+
+def delete_node_if_pinged_before(id: str, before: float) -> bool:
+    """Delete a node unless it pinged since, only one caller gets to evict it"""
+    cursor = _get_db().execute(
+        "DELETE FROM nodes WHERE id = ? AND last_ping < ?", (id, before)
+    )
+    if cursor.rowcount == 0:
+        return False
+    _get_db().execute("DELETE FROM node_commands WHERE node_id = ?", (id,))
+    return True
+
+
+def touch_all_nodes(last_ping: float) -> None:
+    _get_db().execute(
+        "UPDATE nodes"
+        " SET last_ping = ?, document = json_set(document, '$.last_ping', ?)",
+        (last_ping, last_ping),
+    )
 
 
 def find_node_by_id(id: str) -> Node | None:
-    found = active_nodes.get(id)
-    if found is None:
-        return found
-    return found.model_copy()
+    row = _get_db().execute("SELECT document FROM nodes WHERE id = ?", (id,)).fetchone()
+    if row is None:
+        return None
+    return Node.model_validate_json(row[0])
+
+
+def find_all_nodes() -> list[Node]:
+    rows = _get_db().execute("SELECT document FROM nodes")
+    return [Node.model_validate_json(document) for (document,) in rows]
+
+
+def find_node_ids_pinged_before(before: float) -> list[str]:
+    # A range scan over the index, only touches the nodes that are overdue
+    rows = _get_db().execute("SELECT id FROM nodes WHERE last_ping < ?", (before,))
+    return [id for (id,) in rows]
+
+
+def insert_trial_owner(trial_id: int, node_id: str, study_id: int) -> None:
+    _get_db().execute(
+        "INSERT OR REPLACE INTO trial_owners (trial_id, node_id, study_id)"
+        " VALUES (?, ?, ?)",
+        (trial_id, node_id, study_id),
+    )
+
+
+def delete_trial_owner(trial_id: int) -> None:
+    _get_db().execute("DELETE FROM trial_owners WHERE trial_id = ?", (trial_id,))
+
+
+def find_trials_by_owner(node_id: str) -> list[tuple[int, int]]:
+    """The trial and study ids of the unfinished trials a node created"""
+    rows = _get_db().execute(
+        "SELECT trial_id, study_id FROM trial_owners WHERE node_id = ?", (node_id,)
+    )
+    return list(rows)
+
+
+def insert_node_command(node_id: str, command: NodeCommand) -> None:
+    _get_db().execute(
+        "INSERT INTO node_commands (node_id, document) VALUES (?, ?)",
+        (node_id, command.model_dump_json()),
+    )
+
+
+def pop_node_commands(node_id: str) -> list[NodeCommand]:
+    """Take the queued commands of a node in the order they were queued"""
+    db = _get_db()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        rows = db.execute(
+            "SELECT document FROM node_commands WHERE node_id = ? ORDER BY id",
+            (node_id,),
+        ).fetchall()
+        db.execute("DELETE FROM node_commands WHERE node_id = ?", (node_id,))
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    return [NodeCommand.model_validate_json(document) for (document,) in rows]
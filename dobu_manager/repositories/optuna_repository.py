@@ -0,0 +1,73 @@
+import functools
+
+import optuna
+from optuna.storages import RDBStorage
+from optuna.trial import FrozenTrial
+
+from dobu_manager.config import OrchestratorConfig
+
+# Optuna internals, not covered by its compatibility guarantees and verified
+# against optuna 4.2 up to 5.0. Only the functions below use them, each falls
+# back to the public storage API should they move in a later release.
+try:
+    from optuna.storages._rdb import models as _models
+    from optuna.storages._rdb.storage import _create_scoped_session
+except ImportError:
+    _models = None
+    _create_scoped_session = None
+
+
+@functools.cache
+def get_storage() -> RDBStorage:
+    """The process wide optuna storage, sharing one engine and connection pool"""
+    config = OrchestratorConfig.get()
+    return optuna.storages.RDBStorage(
+        config.db_url,
+        engine_kwargs={
+            "pool_size": config.db_pool_size,
+            "max_overflow": config.db_max_overflow,
+            "pool_pre_ping": True,
+        },
+    )
+
+
+def get_trials_after(study_id: int, after_trial_id: int) -> list[FrozenTrial]:
+    """The trials of a study whose id is larger than `after_trial_id`"""
+    storage = get_storage()
+    get_trials = getattr(storage, "_get_trials", None)
+    if get_trials is None:
+        return [
+            trial
+            for trial in storage.get_all_trials(study_id, deepcopy=False)
+            if trial._trial_id > after_trial_id
+        ]
+    # The same query optuna's own cached storage uses for incremental reads
+    return get_trials(
+        study_id,
+        states=None,
+        included_trial_ids=set(),
+        trial_id_greater_than=after_trial_id,
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def get_study_id_of_trial(trial_id: int) -> int:
+    """The study a trial belongs to, which never changes once it is created"""
+    storage = get_storage()
+    if _models is None:
+        number = storage.get_trial_number_from_id(trial_id)
+        for study in storage.get_all_studies():
+            try:
+                if (
+                    storage.get_trial_id_from_study_id_trial_number(
+                        study._study_id, number
+                    )
+                    == trial_id
+                ):
+                    return study._study_id
+            except KeyError:
+                continue
+        raise KeyError(f"No trial with id {trial_id}")
+    with _create_scoped_session(storage.scoped_session) as session:
+        trial = _models.TrialModel.find_or_raise_by_id(trial_id, session)
+        return trial.study_id
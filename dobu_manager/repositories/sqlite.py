@@ -0,0 +1,49 @@
+import functools
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Callable
+
+from dobu_manager.config import OrchestratorConfig
+
+
+def open_connection(db_file: Path) -> sqlite3.Connection:
+    # Autocommit, statements that need to be atomic open their own transaction
+    connection = sqlite3.connect(db_file, timeout=30, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class ThreadLocalConnection:
+    """One connection per thread, sqlite connections may not be shared between them"""
+
+    def __init__(self, get_db_file: Callable[[], Path]):
+        self._get_db_file = get_db_file
+        self._local = threading.local()
+
+    def get(self) -> sqlite3.Connection:
+        connection: sqlite3.Connection | None = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = open_connection(self._get_db_file())
+            self._local.connection = connection
+        return connection
+
+
+def connect(filename: str, schema: str) -> Callable[[], sqlite3.Connection]:
+    """
+    A getter for the connection of the calling thread to `filename` in the data
+    directory. The tables of `schema` are created on first use.
+    """
+
+    @functools.cache
+    def get_db_file() -> Path:
+        db_file = OrchestratorConfig.get().data_dir / filename
+        connection = open_connection(db_file)
+        try:
+            connection.executescript(schema)
+        finally:
+            connection.close()
+        return db_file
+
+    return ThreadLocalConnection(get_db_file).get
@@ -1,78 +1,117 @@
 import functools
+import json
+import sqlite3
 from dataclasses import dataclass
 from pathlib import Path
 
-from filelock import FileLock
 from loguru import logger
-from tinydb import JSONStorage, Query, TinyDB
-from tinydb.middlewares import Middleware
 
 from dobu_manager.config import OrchestratorConfig
-from shared.models.study import CodeBaseStudy
-
-
-class LockLayer(Middleware):
-    def __init__(self, storage_cls):
-        super().__init__(storage_cls)
-        self.lock = None
-
-    def __call__(self, *args, **kwargs):
-        path = Path(args[0]).absolute()
-        self.lock = FileLock(path.with_suffix(".lock"))
-        return super().__call__(*args, **kwargs)
-
-    def write(self, data) -> None:
-        with self.lock:
-            self.storage.write(data)
+from dobu_manager.repositories.sqlite import ThreadLocalConnection, open_connection
+from shared.models.study import CodeBaseStudy, StudyState
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS studies (
+    name TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS studies_state ON studies (state);
+"""
+
+
+def _migrate_tinydb(connection: sqlite3.Connection, json_file: Path) -> None:
+    """Import the studies of the TinyDB file that used to back this repository"""
+    logger.info(f"Migrating studies from {json_file.as_posix()}")
+    content = json_file.read_text()
+    tables = json.loads(content) if content.strip() else {}
+    studies = [
+        CodeBaseStudy.model_validate(document)
+        for document in tables.get("_default", {}).values()
+    ]
+    connection.execute("BEGIN")
+    connection.executemany(
+        "INSERT OR IGNORE INTO studies (name, state, document) VALUES (?, ?, ?)",
+        [(study.name, study.state, study.model_dump_json()) for study in studies],
+    )
+    connection.execute("COMMIT")
+    json_file.rename(json_file.with_suffix(".json.migrated"))
+    logger.info(f"Migrated {len(studies)} studies")
 
 
 @dataclass
 class StudyRepositoryConfig:
-    db: TinyDB
+    db_file: Path
 
     @staticmethod
     def create(config: OrchestratorConfig):
-        db_file = config.data_dir / "db.json"
+        db_file = config.data_dir / "studies.db"
         if not db_file.exists():
             logger.info(f"Creating Study database file: {db_file.as_posix()}")
-            db_file.touch(exist_ok=False)
-        db = TinyDB(db_file, indent=4, storage=LockLayer(JSONStorage))
-        return StudyRepositoryConfig(db=db)
+        connection = open_connection(db_file)
+        try:
+            connection.executescript(_SCHEMA)
+            legacy_file = config.data_dir / "db.json"
+            if legacy_file.exists():
+                _migrate_tinydb(connection, legacy_file)
+        finally:
+            connection.close()
+        return StudyRepositoryConfig(db_file=db_file)
 
 
 @functools.cache
-def _get_db() -> TinyDB:
-    return StudyRepositoryConfig.create(OrchestratorConfig.get()).db
+def _get_config() -> StudyRepositoryConfig:
+    return StudyRepositoryConfig.create(OrchestratorConfig.get())
+
+
+_connection = ThreadLocalConnection(lambda: _get_config().db_file)
+
+
+def _get_db() -> sqlite3.Connection:
+    return _connection.get()
 
 
 def create_study(study: CodeBaseStudy) -> CodeBaseStudy:
-    _get_db().insert(study.model_dump(mode="json"))
+    _get_db().execute(
+        "INSERT INTO studies (name, state, document) VALUES (?, ?, ?)",
+        (study.name, study.state, study.model_dump_json()),
+    )
+    return study
 
 
 def update_study(
     study: CodeBaseStudy,
 ) -> CodeBaseStudy:
-    query = Query()
-    _get_db().update(study.model_dump(mode="json"), query.name == study.name)
+    _get_db().execute(
+        "UPDATE studies SET state = ?, document = ? WHERE name = ?",
+        (study.state, study.model_dump_json(), study.name),
+    )
+    return study
 
 
 def delete_study(
     study_name: str,
 ) -> None:
-    query = Query()
-
-    _get_db().remove(query.name == study_name)
+    _get_db().execute("DELETE FROM studies WHERE name = ?", (study_name,))
 
 
 def find_study_by_name(study_name: str) -> CodeBaseStudy | None:
-    query = Query()
+    row = (
+        _get_db()
+        .execute("SELECT document FROM studies WHERE name = ?", (study_name,))
+        .fetchone()
+    )
+    if row is None:
+        return None
+
+    return CodeBaseStudy.model_validate_json(row[0])
 
-    raw = _get_db().get(query.name == study_name)
-    if raw is None:
-        return raw
 
-    return CodeBaseStudy.model_validate(raw)
+def find_studies_by_state(state: StudyState) -> list[CodeBaseStudy]:
+    rows = _get_db().execute("SELECT document FROM studies WHERE state = ?", (state,))
+    return [CodeBaseStudy.model_validate_json(document) for (document,) in rows]
 
 
 def find_all_studies() -> list[CodeBaseStudy]:
-    return [CodeBaseStudy.model_validate(doc) for doc in _get_db().all()]
+    rows = _get_db().execute("SELECT document FROM studies")
+    return [CodeBaseStudy.model_validate_json(document) for (document,) in rows]
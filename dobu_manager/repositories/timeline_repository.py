@@ -0,0 +1,59 @@
+from dobu_manager.repositories.sqlite import connect
+from shared.models.timeline import TrialTimeline
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS trial_timelines (
+    trial_id INTEGER PRIMARY KEY,
+    study_id INTEGER NOT NULL,
+    document TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS trial_timelines_study ON trial_timelines (study_id);
+"""
+
+_get_db = connect("timelines.db", _SCHEMA)
+
+
+def upsert_timeline(trial_id: int, study_id: int, timeline: TrialTimeline) -> None:
+    _get_db().execute(
+        "INSERT OR REPLACE INTO trial_timelines (trial_id, study_id, document)"
+        " VALUES (?, ?, ?)",
+        (trial_id, study_id, timeline.model_dump_json()),
+    )
+
+
+def find_timelines_by_study(study_id: int) -> list[TrialTimeline]:
+    rows = _get_db().execute(
+        "SELECT document FROM trial_timelines WHERE study_id = ?", (study_id,)
+    )
+    return [TrialTimeline.model_validate_json(document) for (document,) in rows]
+
+
+def delete_timelines_beyond(keep_per_study: int) -> int:
+    """Keep the timelines of the latest `keep_per_study` trials of every study"""
+    cursor = _get_db().execute(
+        "DELETE FROM trial_timelines WHERE trial_id IN ("
+        " SELECT trial_id FROM ("
+        "  SELECT trial_id, ROW_NUMBER() OVER"
+        "   (PARTITION BY study_id ORDER BY trial_id DESC) AS position"
+        "  FROM trial_timelines"
+        " ) WHERE position > ?"
+        ")",
+        (keep_per_study,),
+    )
+    return cursor.rowcount
+
+
+def delete_timelines_of_deleted_studies(study_ids: list[int]) -> int:
+    """
+    Delete the timelines of studies that are not in `study_ids`, the existing
+    studies. Studies created after the newest of them are left alone.
+    """
+    if len(study_ids) == 0:
+        return 0
+    placeholders = ", ".join("?" * len(study_ids))
+    cursor = _get_db().execute(
+        f"DELETE FROM trial_timelines WHERE study_id NOT IN ({placeholders})"
+        " AND study_id < ?",
+        (*study_ids, max(study_ids)),
+    )
+    return cursor.rowcount
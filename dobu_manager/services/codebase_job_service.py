@@ -0,0 +1,110 @@
+"""Extract and validate uploaded code bases off the event loop"""
+
+from __future__ import annotations
+
+import asyncio
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Literal
+
+from loguru import logger
+from pydantic import BaseModel
+
+from dobu_manager.repositories.codebase_job_repository import (
+    find_job_by_id,
+    upsert_job,
+)
+from dobu_manager.services.codebase_service import KoduConfig, check_codebase
+from dobu_manager.services.study_service import (
+    discard_unpacked_codebase,
+    mark_codebase_valid,
+    unpack_codebase,
+    update_study_codebase,
+)
+
+type CodebaseJobStatus = Literal["pending"] | Literal["ok"] | Literal["failed"]
+
+
+class CodebaseJob(BaseModel):
+    id: str
+    study_name: str
+    codebase_hash: str
+    status: CodebaseJobStatus = "pending"
+    detail: str | None = None
+    config: KoduConfig | None = None
+
+
+_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="codebase-job")
+
+
+def _save(job: CodebaseJob) -> None:
+    upsert_job(job.id, job.model_dump_json())
+
+
+def _validate(job: CodebaseJob) -> CodebaseJob:
+    unpacked_dir = unpack_codebase(job.study_name, job.codebase_hash)
+    try:
+        code_base_state, config = check_codebase(unpacked_dir)
+        if code_base_state != "ok":
+            return job.model_copy(
+                update={"status": "failed", "detail": code_base_state, "config": config}
+            )
+        mark_codebase_valid(job.study_name, job.codebase_hash, unpacked_dir)
+    finally:
+        # Only left behind when the code base was rejected
+        discard_unpacked_codebase(unpacked_dir)
+    return job.model_copy(update={"status": "ok", "config": config})
+
+
+def _update(job: CodebaseJob) -> CodebaseJob:
+    job = _validate(job)
+    if job.status == "ok":
+        update_study_codebase(job.study_name, job.codebase_hash)
+    return job
+
+
+def _submit(
+    job: CodebaseJob, task: Callable[[CodebaseJob], CodebaseJob]
+) -> CodebaseJob:
+    _save(job)
+
+    def on_done(future: Future[CodebaseJob]) -> None:
+        try:
+            _save(future.result())
+        except Exception as e:
+            logger.exception(f"Code base job {job.id} for {job.study_name} crashed")
+            _save(job.model_copy(update={"status": "failed", "detail": str(e)}))
+
+    _pool.submit(task, job).add_done_callback(on_done)
+    return job
+
+
+def submit_validation(study_name: str, codebase_hash: str) -> CodebaseJob:
+    """Unpack and check the code base of a study that is yet to be created"""
+    job = CodebaseJob(
+        id=uuid.uuid4().hex, study_name=study_name, codebase_hash=codebase_hash
+    )
+    return _submit(job, _validate)
+
+
+async def run_validation(study_name: str, codebase_hash: str) -> CodebaseJob:
+    """Check a code base like `submit_validation`, waiting for the result"""
+    job = CodebaseJob(
+        id=uuid.uuid4().hex, study_name=study_name, codebase_hash=codebase_hash
+    )
+    return await asyncio.wrap_future(_pool.submit(_validate, job))
+
+
+def submit_update(study_name: str, codebase_hash: str) -> CodebaseJob:
+    """Unpack and check a new code base, switching the study over when it is valid"""
+    job = CodebaseJob(
+        id=uuid.uuid4().hex, study_name=study_name, codebase_hash=codebase_hash
+    )
+    return _submit(job, _update)
+
+
+def get_job(job_id: str) -> CodebaseJob | None:
+    document = find_job_by_id(job_id)
+    if document is None:
+        return None
+    return CodebaseJob.model_validate_json(document)
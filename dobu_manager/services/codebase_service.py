@@ -5,12 +5,21 @@ from pathlib import Path
 from typing import Literal
 
 from packaging.requirements import Requirement
-from pydantic import BaseModel, ValidationError
+from pydantic import BaseModel, Field, ValidationError
+
+from shared.models.study import ObjectiveMode
+
+BATCH_ARGUMENT_TYPE = "TrialBatch"
+"""The annotation that marks the argument of a batch objective"""
 
 
 class KoduConfig(BaseModel):
     objective_function: str
     objective_file: str
+    objective_mode: ObjectiveMode = "single"
+    """`batch` objectives take a `TrialBatch` and return one value per trial"""
+    batch_size: int = Field(default=32, ge=1, le=1000)
+    """Leased in one request, at most as many as a lease allows"""
 
 
 type DependencyState = (
@@ -24,6 +33,7 @@ type FunctionState = (
     Literal["Not present"]
     | Literal["Function Not found"]
     | Literal["Invalid Argument count"]
+    | Literal["Invalid Argument type"]
     | Literal["Invalid return"]
     | Literal["ok"]
 )
@@ -38,7 +48,9 @@ def check_codebase(path: Path) -> tuple[CodebaseState, KoduConfig | None]:
         return "invalid config", None
 
     function_path = path / config.objective_file
-    function_result = check_function(function_path, config.objective_function)
+    function_result = check_function(
+        function_path, config.objective_function, config.objective_mode
+    )
     if function_result != "ok":
         return function_result, config
 
@@ -62,7 +74,19 @@ def check_config_file(path: Path) -> KoduConfig | None:
             return None
 
 
-def check_function(function_path: Path, function_name) -> FunctionState:
+def _annotation_name(annotation: ast.expr | None) -> str | None:
+    if isinstance(annotation, ast.Name):
+        return annotation.id
+    if isinstance(annotation, ast.Attribute):
+        return annotation.attr
+    if isinstance(annotation, ast.Constant) and isinstance(annotation.value, str):
+        return annotation.value.rsplit(".", 1)[-1]
+    return None
+
+
+def check_function(
+    function_path: Path, function_name, objective_mode: ObjectiveMode = "single"
+) -> FunctionState:
     if not function_path.exists():
         return "Not present"
 
@@ -80,6 +104,12 @@ def check_function(function_path: Path, function_name) -> FunctionState:
         proposed_function = objective_functions[0]
         if len(proposed_function.args.args) != 1:
             return "Invalid Argument count"
+        # An annotated argument has to agree with the declared objective mode
+        annotation = _annotation_name(proposed_function.args.args[0].annotation)
+        if annotation is not None and (annotation == BATCH_ARGUMENT_TYPE) != (
+            objective_mode == "batch"
+        ):
+            return "Invalid Argument type"
 
         class ReturnVisitor(ast.NodeVisitor):
             def __init__(self):
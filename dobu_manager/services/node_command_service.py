@@ -0,0 +1,40 @@
+"""Control commands handed to nodes in the response to their ping"""
+
+from dobu_manager.repositories.node_repository import (
+    insert_node_command,
+    pop_node_commands,
+)
+from dobu_manager.repositories.optuna_repository import get_storage
+from dobu_manager.repositories.study_repository import find_study_by_name
+from dobu_manager.services.optuna_service import remaining_trials
+from shared.models.node import NodeCommand, NodePing
+
+
+def queue_command(node_id: str, command: NodeCommand) -> None:
+    insert_node_command(node_id, command)
+
+
+def commands_for_ping(ping: NodePing) -> list[NodeCommand]:
+    """
+    The queued commands of the node, plus a stop for every slot that works on a
+    study that is no longer running or used up its trial budget. The stop is
+    repeated on every ping until the slot reports it moved on, a lost response
+    is never a lost command.
+    """
+    commands = pop_node_commands(ping.node_id)
+    for slot in ping.slots:
+        if slot.status == "idle" or slot.study_name is None:
+            continue
+        if _should_stop(slot.study_name):
+            commands.append(NodeCommand(kind="stop_after_trial", slot=slot.index))
+    return commands
+
+
+def _should_stop(study_name: str) -> bool:
+    study = find_study_by_name(study_name)
+    if study is None or study.state != "running":
+        return True
+    if study.scheduling.max_trials is None:
+        return False
+    study_id = get_storage().get_study_id_from_name(study_name)
+    return remaining_trials(study_id, study) == 0
@@ -1,12 +1,17 @@
 import time
+from collections import Counter
 
 from dobu_manager.repositories.node_repository import (
     delete_node,
+    delete_trial_owner,
+    find_all_nodes,
     find_node_by_id,
     insert_node,
-    update_node,
+    insert_trial_owner,
+    modify_node,
 )
-from shared.models.node import Node, NodePing, NodeRegistration
+from dobu_manager.repositories.optuna_repository import get_study_id_of_trial
+from shared.models.node import Node, NodePing, NodeRegistration, SlotState
 
 
 def register_node(registration: NodeRegistration) -> Node:
@@ -14,16 +19,20 @@ def register_node(registration: NodeRegistration) -> Node:
         id=registration.node_id,
         capabilities=registration.capabilities,
         last_ping=time.time(),
+        slots=[SlotState(index=index) for index in range(registration.slot_count)],
     )
     return insert_node(node)
 
 
-def update_node_ping(ping: NodePing) -> Node:
-    node = find_node_by_id(ping.node_id)
-    node.last_ping = time.time()
-    node.current_trial = ping.current_trial_id
-    node.status = ping.status
-    return update_node(node)
+def update_node_ping(ping: NodePing) -> Node | None:
+    def change(node: Node) -> Node:
+        node.last_ping = time.time()
+        node.current_trial = ping.current_trial_id
+        node.status = ping.status
+        node.slots = ping.slots
+        return node
+
+    return modify_node(ping.node_id, change)
 
 
 def remove_node(id: str) -> None:
@@ -32,3 +41,52 @@ def remove_node(id: str) -> None:
 
 def node_exists(id: str) -> bool:
     return find_node_by_id(id) is not None
+
+
+def get_node(id: str) -> Node | None:
+    return find_node_by_id(id)
+
+
+def get_all_nodes() -> list[Node]:
+    return find_all_nodes()
+
+
+def assign_slot(node_id: str, slot_index: int, study_name: str | None) -> None:
+    """
+    Record which study a slot was handed, so scheduling decisions made before
+    the next ping of the node already take it into account
+    """
+
+    def change(node: Node) -> Node:
+        node.slots = [
+            SlotState(
+                index=slot.index,
+                status="preparing" if study_name is not None else "idle",
+                study_name=study_name,
+            )
+            if slot.index == slot_index
+            else slot
+            for slot in node.slots
+        ]
+        return node
+
+    modify_node(node_id, change)
+
+
+def count_study_assignments() -> Counter[str]:
+    """The number of slots, over all nodes, that are working on each study"""
+    return Counter(
+        slot.study_name
+        for node in find_all_nodes()
+        for slot in node.slots
+        if slot.study_name is not None and slot.status != "idle"
+    )
+
+
+def record_trial_owner(node_id: str, trial_id: int) -> None:
+    """Remember which node runs a trial, so it can be reclaimed when the node dies"""
+    insert_trial_owner(trial_id, node_id, get_study_id_of_trial(trial_id))
+
+
+def release_trial(trial_id: int) -> None:
+    delete_trial_owner(trial_id)
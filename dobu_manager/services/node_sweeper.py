@@ -0,0 +1,115 @@
+"""
+Evict nodes that stopped pinging and reclaim the trials they were running, and
+return leased trials that were not told in time to their study
+"""
+
+import asyncio
+import time
+
+from loguru import logger
+from optuna.trial import TrialState
+
+from dobu_manager.config import OrchestratorConfig
+from dobu_manager.repositories import lease_repository
+from dobu_manager.repositories.node_repository import (
+    delete_node_if_pinged_before,
+    delete_trial_owner,
+    find_node_ids_pinged_before,
+    find_trials_by_owner,
+)
+from dobu_manager.repositories.optuna_repository import get_storage
+from dobu_manager.services import optuna_service, timeline_service
+from shared.models.optuna import FAIL_REASON_ATTR
+
+
+def reclaim_trial(trial_id: int, study_id: int, reason: str, requeue: bool) -> None:
+    """Fail a trial that will never be told, optionally enqueueing its parameters"""
+    storage = get_storage()
+    trial = storage.get_trial(trial_id)
+    if trial.state != TrialState.RUNNING:
+        return
+    storage.set_trial_system_attr(trial_id, FAIL_REASON_ATTR, reason)
+    try:
+        storage.set_trial_state_values(trial_id, TrialState.FAIL)
+    except RuntimeError:
+        # Told in the meantime
+        return
+    optuna_service.record_finished_trial(trial_id, TrialState.FAIL)
+    if requeue and not optuna_service.requeue(study_id, trial):
+        logger.warning(
+            f"Not requeueing the parameters of trial {trial_id}, they were"
+            " already retried the maximum number of times"
+        )
+
+
+def sweep_dead_nodes(now: float) -> list[str]:
+    """
+    Evict every node whose last ping is older than the allowed number of ping
+    intervals and reclaim its trials. Only overdue nodes are looked at, so a
+    sweep costs the same for any fleet size.
+    """
+    config = OrchestratorConfig.get()
+    deadline = now - config.ping_interval_seconds * config.missed_pings_before_eviction
+    evicted = []
+    for node_id in find_node_ids_pinged_before(deadline):
+        # Other orchestrator processes sweep as well, one of them wins the node
+        if not delete_node_if_pinged_before(node_id, deadline):
+            continue
+        evicted.append(node_id)
+        trials = find_trials_by_owner(node_id)
+        logger.warning(
+            f"Node {node_id} stopped pinging, reclaiming {len(trials)} trial(s)"
+        )
+        for trial_id, study_id in trials:
+            try:
+                reclaim_trial(
+                    trial_id,
+                    study_id,
+                    reason=f"Node {node_id} stopped responding",
+                    requeue=config.orphaned_trials == "requeue",
+                )
+            except Exception:
+                logger.exception(f"Failed to reclaim trial {trial_id}")
+            delete_trial_owner(trial_id)
+    return evicted
+
+
+def sweep_expired_leases(now: float) -> list[int]:
+    """
+    Fail every leased trial that was not told before its lease expired and
+    enqueue its parameters again, so another executor evaluates them.
+    """
+    expired = []
+    for trial_id, study_id in lease_repository.find_leases_expired_before(now):
+        # Other orchestrator processes sweep as well, one of them wins the lease
+        if not lease_repository.delete_lease(trial_id):
+            continue
+        expired.append(trial_id)
+        try:
+            reclaim_trial(
+                trial_id, study_id, reason="Trial lease expired", requeue=True
+            )
+        except Exception:
+            logger.exception(f"Failed to reclaim trial {trial_id}")
+    if expired:
+        logger.warning(f"Returned {len(expired)} trial(s) with an expired lease")
+    return expired
+
+
+async def run_sweeper() -> None:
+    """Sweep once per ping interval, so eviction lags a deadline by one interval"""
+    interval = OrchestratorConfig.get().ping_interval_seconds
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(sweep_dead_nodes, time.time())
+        except Exception:
+            logger.exception("Sweeping dead nodes failed")
+        try:
+            await asyncio.to_thread(sweep_expired_leases, time.time())
+        except Exception:
+            logger.exception("Sweeping expired leases failed")
+        try:
+            await asyncio.to_thread(timeline_service.prune_timelines)
+        except Exception:
+            logger.exception("Pruning trial timelines failed")
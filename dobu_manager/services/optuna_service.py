@@ -0,0 +1,308 @@
+from __future__ import annotations
+
+import threading
+import time
+from dataclasses import dataclass, field
+
+import optuna
+from loguru import logger
+from optuna.distributions import BaseDistribution
+from optuna.pruners import BasePruner
+from optuna.samplers import BaseSampler
+from optuna.search_space import IntersectionSearchSpace
+from optuna.storages import RDBStorage
+from optuna.trial import FrozenTrial, TrialState
+from sqlalchemy.exc import SQLAlchemyError
+
+from dobu_manager import metrics
+from dobu_manager.config import OrchestratorConfig
+from dobu_manager.repositories import lease_repository
+from dobu_manager.repositories.optuna_repository import (
+    get_storage,
+    get_study_id_of_trial,
+)
+from dobu_manager.repositories.study_repository import find_study_by_name
+from dobu_manager.services import node_service, timeline_service
+from shared.models.optuna import (
+    OptunaRejectedWrite,
+    OptunaTrialResult,
+    OptunaTrialWrite,
+    OptunaWriteAttr,
+    OptunaWriteBatchResponse,
+    OptunaWriteIntermediateValue,
+    OptunaWriteParam,
+    OptunaWriteStateValues,
+    OptunaWriteTimeline,
+)
+from shared.models.study import CodeBaseStudy, PrunerName, SamplerName
+
+
+@dataclass
+class _LoadedStudy:
+    study: optuna.Study
+    search_space: IntersectionSearchSpace
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    """The sampler, pruner and search space are not safe to use concurrently"""
+
+
+REQUEUE_COUNT_ATTR = "kodu:requeue_count"
+"""User attr counting how often the parameters of a trial were enqueued again"""
+
+_loaded_studies: dict[int, _LoadedStudy] = {}
+_loaded_studies_lock = threading.Lock()
+
+
+def create_sampler(name: SamplerName) -> BaseSampler:
+    if name == "tpe":
+        return optuna.samplers.TPESampler()
+    if name == "random":
+        return optuna.samplers.RandomSampler()
+    if name == "cmaes":
+        return optuna.samplers.CmaEsSampler()
+    if name == "qmc":
+        return optuna.samplers.QMCSampler()
+    raise ValueError(f"Unknown sampler: {name}")
+
+
+def create_pruner(name: PrunerName) -> BasePruner:
+    if name == "median":
+        return optuna.pruners.MedianPruner()
+    if name == "hyperband":
+        return optuna.pruners.HyperbandPruner()
+    if name == "successive_halving":
+        return optuna.pruners.SuccessiveHalvingPruner()
+    if name == "nop":
+        return optuna.pruners.NopPruner()
+    raise ValueError(f"Unknown pruner: {name}")
+
+
+def _get_loaded_study(study_id: int) -> _LoadedStudy:
+    # Samplers keep state between trials, so every study is loaded once
+    with _loaded_studies_lock:
+        loaded = _loaded_studies.get(study_id)
+        if loaded is not None:
+            return loaded
+
+        storage = get_storage()
+        name = storage.get_study_name_from_id(study_id)
+        codebase_study = find_study_by_name(name)
+        sampler = create_sampler(
+            codebase_study.sampler if codebase_study is not None else "tpe"
+        )
+        pruner = create_pruner(
+            codebase_study.pruner if codebase_study is not None else "median"
+        )
+        loaded = _LoadedStudy(
+            study=optuna.load_study(
+                study_name=name, storage=storage, sampler=sampler, pruner=pruner
+            ),
+            search_space=IntersectionSearchSpace(),
+        )
+        _loaded_studies[study_id] = loaded
+        return loaded
+
+
+class TrialBudgetExhausted(Exception):
+    """The study already has the number of trials its scheduling allows"""
+
+
+def remaining_trials(study_id: int, study: CodeBaseStudy | None) -> int | None:
+    """How many trials the study may still create, None when it has no budget"""
+    if study is None or study.scheduling.max_trials is None:
+        return None
+    return max(0, study.scheduling.max_trials - get_storage().get_n_trials(study_id))
+
+
+def reserve_trials(study_id: int, count: int) -> int:
+    """
+    How many of `count` new trials fit in the trial budget of the study, raises
+    `TrialBudgetExhausted` when none do
+    """
+    name = _get_loaded_study(study_id).study.study_name
+    remaining = remaining_trials(study_id, find_study_by_name(name))
+    if remaining is None:
+        return count
+    if remaining == 0:
+        raise TrialBudgetExhausted(f"Study {name} reached its trial budget")
+    return min(count, remaining)
+
+
+def _ask(
+    loaded: _LoadedStudy, distributions: dict[str, BaseDistribution] | None
+) -> int:
+    if distributions is None:
+        distributions = loaded.search_space.calculate(loaded.study)
+    return loaded.study.ask(fixed_distributions=distributions)._trial_id
+
+
+def ask(
+    study_id: int, distributions: dict[str, BaseDistribution] | None
+) -> FrozenTrial:
+    """Create a trial and sample all of its parameters next to the database"""
+    loaded = _get_loaded_study(study_id)
+    # Checked under the lock, concurrent asks of this process can not overshoot
+    with loaded.lock:
+        reserve_trials(study_id, 1)
+        trial_id = _ask(loaded, distributions)
+    return get_storage().get_trial(trial_id)
+
+
+def lease(
+    study_id: int,
+    count: int,
+    lease_seconds: float,
+    distributions: dict[str, BaseDistribution] | None,
+) -> tuple[list[FrozenTrial], float]:
+    """
+    Ask up to `count` trials at once for an executor that tells them together,
+    fewer when the trial budget of the study runs out. Returns the trials and
+    when their lease expires, after which the sweeper fails and requeues the
+    ones that were not told.
+    """
+    loaded = _get_loaded_study(study_id)
+    with loaded.lock:
+        count = reserve_trials(study_id, count)
+        trial_ids = [_ask(loaded, distributions) for _ in range(count)]
+    expires_at = time.time() + lease_seconds
+    lease_repository.insert_leases(trial_ids, study_id, expires_at)
+    storage = get_storage()
+    return [storage.get_trial(trial_id) for trial_id in trial_ids], expires_at
+
+
+class TrialNotInStudy(Exception):
+    """A trial was addressed through a study it does not belong to"""
+
+
+def check_trials_in_study(study_id: int, trial_ids: list[int]) -> None:
+    """Raises `TrialNotInStudy` unless every trial belongs to the study"""
+    for trial_id in trial_ids:
+        try:
+            trial_study_id = get_study_id_of_trial(trial_id)
+        except KeyError:
+            raise TrialNotInStudy(f"No trial with id {trial_id}")
+        if trial_study_id != study_id:
+            raise TrialNotInStudy(
+                f"Trial {trial_id} does not belong to study {study_id}"
+            )
+
+
+def tell(study_id: int, results: list[OptunaTrialResult]) -> list[bool]:
+    """
+    Finish a batch of trials of the study, returns per trial whether it was
+    updated. Nothing is told when one of them belongs to another study.
+    """
+    check_trials_in_study(study_id, [result.trial_id for result in results])
+    storage = get_storage()
+    did_update = []
+    for result in results:
+        try:
+            updated = storage.set_trial_state_values(
+                result.trial_id, state=result.state, values=result.values
+            )
+        except RuntimeError:
+            # Finished in the meantime, most likely because its lease expired
+            updated = False
+        if updated and result.state.is_finished():
+            record_finished_trial(result.trial_id, result.state)
+            node_service.release_trial(result.trial_id)
+            lease_repository.delete_lease(result.trial_id)
+        did_update.append(updated)
+    return did_update
+
+
+def requeue(study_id: int, trial: FrozenTrial) -> bool:
+    """
+    Enqueue the parameters of a trial that did not get to finish. Parameters
+    that keep crashing or hanging their executor are given up on after
+    `max_requeues` attempts, returns whether they were enqueued.
+    """
+    attempts = trial.user_attrs.get(REQUEUE_COUNT_ATTR, 0)
+    if attempts >= OrchestratorConfig.get().max_requeues:
+        return False
+    loaded = _get_loaded_study(study_id)
+    with loaded.lock:
+        loaded.study.enqueue_trial(
+            trial.params,
+            user_attrs={
+                "kodu:requeued_from": trial.number,
+                REQUEUE_COUNT_ATTR: attempts + 1,
+            },
+        )
+    return True
+
+
+def should_prune(study_id: int, trial_id: int) -> bool:
+    """Evaluate the pruner of the study next to the trial history"""
+    check_trials_in_study(study_id, [trial_id])
+    loaded = _get_loaded_study(study_id)
+    trial = get_storage().get_trial(trial_id)
+    with loaded.lock:
+        return loaded.study.pruner.prune(loaded.study, trial)
+
+
+def record_finished_trial(trial_id: int, state: TrialState) -> None:
+    metrics.trials_finished.inc(str(get_study_id_of_trial(trial_id)), state.name)
+
+
+def apply_writes(
+    writes: list[OptunaTrialWrite], node_id: str | None = None
+) -> OptunaWriteBatchResponse:
+    """
+    Apply a batch of trial mutations in order, on behalf of the executor on
+    `node_id` if known.
+
+    Every write commits on its own, so the response tells which writes the
+    storage refused and where the batch stopped should the storage fail
+    midway. A state write to an already finished trial is not refused, it
+    reports `did_update=False`.
+    """
+    storage = get_storage()
+    response = OptunaWriteBatchResponse()
+    for index, write in enumerate(writes):
+        try:
+            _apply_write(storage, write, node_id, response)
+        except (ValueError, RuntimeError) as e:
+            response.rejected.append(OptunaRejectedWrite(index=index, detail=str(e)))
+        except SQLAlchemyError as e:
+            logger.exception(f"Stopped applying a batch of writes at {index}")
+            response.stopped_at = index
+            response.error = repr(e)
+            break
+    return response
+
+
+def _apply_write(
+    storage: RDBStorage,
+    write: OptunaTrialWrite,
+    node_id: str | None,
+    response: OptunaWriteBatchResponse,
+) -> None:
+    if isinstance(write, OptunaWriteParam):
+        storage.set_trial_param(
+            write.trial_id,
+            write.name,
+            write.value,
+            optuna.distributions.json_to_distribution(write.distribution),
+        )
+    elif isinstance(write, OptunaWriteIntermediateValue):
+        storage.set_trial_intermediate_value(write.trial_id, write.step, write.value)
+    elif isinstance(write, OptunaWriteAttr) and write.kind == "user_attr":
+        storage.set_trial_user_attr(write.trial_id, write.key, write.value)
+    elif isinstance(write, OptunaWriteAttr):
+        storage.set_trial_system_attr(write.trial_id, write.key, write.value)
+    elif isinstance(write, OptunaWriteStateValues):
+        try:
+            did_update = storage.set_trial_state_values(
+                write.trial_id, state=write.state, values=write.values
+            )
+        except RuntimeError:
+            did_update = False
+        response.did_update = did_update
+        if did_update and write.state.is_finished():
+            record_finished_trial(write.trial_id, write.state)
+            node_service.release_trial(write.trial_id)
+        elif did_update and write.state == TrialState.RUNNING and node_id:
+            # An executor took a waiting trial
+            node_service.record_trial_owner(node_id, write.trial_id)
+    elif isinstance(write, OptunaWriteTimeline):
+        timeline_service.record_timeline(write.trial_id, write.timeline)
@@ -0,0 +1,94 @@
+"""Decide which running study a worker slot should work on"""
+
+from __future__ import annotations
+
+import random
+from collections import Counter
+from dataclasses import dataclass
+from typing import Callable, Literal, Protocol
+
+from shared.models.node import Node
+from shared.models.study import CodeBaseStudy
+
+type SchedulerName = Literal["fair_share"] | Literal["random"]
+
+
+@dataclass
+class SchedulingContext:
+    node: Node | None
+    """The node asking for work, None for requests that do not identify themselves"""
+    assignments: Counter[str]
+    """The number of slots currently working on each study"""
+    count_trials: Callable[[CodeBaseStudy], int]
+
+
+def is_eligible(study: CodeBaseStudy, context: SchedulingContext) -> bool:
+    scheduling = study.scheduling
+    if context.node is not None:
+        capabilities = context.node.capabilities
+        if (
+            scheduling.min_cpu_count is not None
+            and capabilities.cpu_count < scheduling.min_cpu_count
+        ):
+            return False
+        if (
+            scheduling.min_memory_gb is not None
+            and capabilities.memory_gb < scheduling.min_memory_gb
+        ):
+            return False
+    if (
+        scheduling.max_concurrency is not None
+        and context.assignments[study.name] >= scheduling.max_concurrency
+    ):
+        return False
+    if (
+        scheduling.max_trials is not None
+        and context.count_trials(study) >= scheduling.max_trials
+    ):
+        return False
+    return True
+
+
+class StudyScheduler(Protocol):
+    def rank(
+        self, studies: list[CodeBaseStudy], context: SchedulingContext
+    ) -> list[CodeBaseStudy]:
+        """Return the studies the node may work on, the most deserving first"""
+        ...
+
+
+class RandomScheduler:
+    def rank(
+        self, studies: list[CodeBaseStudy], context: SchedulingContext
+    ) -> list[CodeBaseStudy]:
+        eligible = [study for study in studies if is_eligible(study, context)]
+        random.shuffle(eligible)
+        return eligible
+
+
+class FairShareScheduler:
+    """
+    Hand out the study that has the fewest workers relative to its priority,
+    so large studies can not starve small ones
+    """
+
+    def rank(
+        self, studies: list[CodeBaseStudy], context: SchedulingContext
+    ) -> list[CodeBaseStudy]:
+        eligible = [study for study in studies if is_eligible(study, context)]
+        # Shuffle first so studies with an equal share are picked evenly
+        random.shuffle(eligible)
+        return sorted(
+            eligible,
+            key=lambda study: (
+                context.assignments[study.name] / max(study.scheduling.priority, 1e-9)
+            ),
+        )
+
+
+def create_scheduler(name: SchedulerName) -> StudyScheduler:
+    if name == "fair_share":
+        return FairShareScheduler()
+    if name == "random":
+        return RandomScheduler()
+    raise ValueError(f"Unknown scheduler: {name}")
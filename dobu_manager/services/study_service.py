@@ -1,27 +1,87 @@
 from __future__ import annotations
 
+import asyncio
 import datetime
-import random
+import hashlib
 import shutil
+import tempfile
+from collections import Counter
 from functools import cache
 from pathlib import Path
+from typing import IO
 
 import optuna
 from fastapi import UploadFile
 
 from dobu_manager.config import OrchestratorConfig
+from dobu_manager.repositories.optuna_repository import get_storage
 from dobu_manager.repositories.study_repository import (
     create_study,
     find_all_studies,
+    find_studies_by_state,
     find_study_by_name,
     update_study,
 )
-from shared.models.study import CodeBaseStudy, CreateStudy
+from dobu_manager.services.codebase_service import check_config_file
+from dobu_manager.services.node_command_service import queue_command
+from dobu_manager.services.node_service import (
+    assign_slot,
+    count_study_assignments,
+    get_all_nodes,
+    get_node,
+)
+from dobu_manager.services.study_scheduler import (
+    SchedulingContext,
+    StudyScheduler,
+    create_scheduler,
+    is_eligible,
+)
+from dobu_manager.services.zip_service import extract_zip
+from shared.models.node import NodeCommand
+from shared.models.study import CodeBaseStudy, CreateStudy, StudyScheduling
+
+CODEBASE_HASH_FILE = ".codebase-hash"
+"""Records which code base zip is unpacked in a study directory"""
+
+
+STUDY_RECHECK_SECONDS = 5
+"""How often a long-poll looks at the database even without a notification"""
+
+_studies_changed = asyncio.Event()
+_studies_changed_loop: asyncio.AbstractEventLoop | None = None
+"""The event loop the long-polls wait on, known once the first one waited"""
+
+
+def _set_studies_changed() -> None:
+    global _studies_changed
+    changed, _studies_changed = _studies_changed, asyncio.Event()
+    changed.set()
+
+
+def _notify_studies_changed() -> None:
+    """Wake up every long-poll waiting for a study, from any thread"""
+    loop = _studies_changed_loop
+    if loop is not None and not loop.is_closed():
+        loop.call_soon_threadsafe(_set_studies_changed)
+
+
+@cache
+def get_scheduler() -> StudyScheduler:
+    return create_scheduler(OrchestratorConfig.get().scheduler)
 
 
 @cache
 def _get_studies_dir() -> Path:
-    return OrchestratorConfig.get().data_dir / "studies"
+    studies_dir = OrchestratorConfig.get().data_dir / "studies"
+    studies_dir.mkdir(parents=True, exist_ok=True)
+    return studies_dir
+
+
+@cache
+def _get_codebases_dir() -> Path:
+    codebases_dir = OrchestratorConfig.get().data_dir / "codebases"
+    codebases_dir.mkdir(parents=True, exist_ok=True)
+    return codebases_dir
 
 
 def insert_study(data: CreateStudy) -> CodeBaseStudy:
@@ -31,14 +91,24 @@ def insert_study(data: CreateStudy) -> CodeBaseStudy:
         created_at=datetime.datetime.now(),
         objective_file=data.objective_file,
         objective_function=data.objective_function,
+        sampler=data.sampler,
+        server_side_sampling=data.server_side_sampling,
+        pruner=data.pruner,
+        codebase_hash=get_unpacked_codebase_hash(data.name),
+        scheduling=data.scheduling,
+        trial_timeout_seconds=data.trial_timeout_seconds,
+        lease_size=data.lease_size,
+        lease_seconds=data.lease_seconds,
     )
+    _apply_codebase_config(study)
     optuna.create_study(
-        storage=OrchestratorConfig.get().db_url,
+        storage=get_storage(),
         direction=study.direction,
         study_name=study.name,
     )
 
     create_study(study)
+    _notify_studies_changed()
     return study
 
 
@@ -55,22 +125,75 @@ def does_study_exists(name: str) -> bool:
 
 
 def is_codebase_present(name: str) -> bool:
-    study_dir = _get_studies_dir() / name
-    return study_dir.exists() and len(list(study_dir.iterdir())) > 0
+    """Whether a code base for the study was uploaded and passed validation"""
+    return get_unpacked_codebase_hash(name) is not None
 
 
-def select_single_study() -> CodeBaseStudy | None:
-    all_studies = find_all_studies()
-    eligible = [study for study in all_studies if study.state == "running"]
-    if len(eligible) == 0:
-        return None
-    return random.choice(eligible)
+def _count_trials(study: CodeBaseStudy) -> int:
+    storage = get_storage()
+    return storage.get_n_trials(storage.get_study_id_from_name(study.name))
+
+
+def rank_studies(node_id: str | None, slot: int | None) -> list[CodeBaseStudy]:
+    """The running studies the node may work on, the most deserving first"""
+    node = get_node(node_id) if node_id is not None else None
+    assignments = count_study_assignments()
+    if node is not None and slot is not None:
+        # The slot is asking for new work, it no longer counts for its old study
+        for node_slot in node.slots:
+            if node_slot.index == slot and node_slot.study_name is not None:
+                assignments[node_slot.study_name] -= 1
+
+    return get_scheduler().rank(
+        find_studies_by_state("running"),
+        SchedulingContext(
+            node=node, assignments=assignments, count_trials=_count_trials
+        ),
+    )
+
+
+def select_single_study(
+    node_id: str | None = None, slot: int | None = None
+) -> CodeBaseStudy | None:
+    """
+    The study to hand out next. Only reads unless a study is selected, which is
+    then recorded as the assignment of the slot.
+    """
+    ranked = rank_studies(node_id, slot)
+    selected = ranked[0] if len(ranked) > 0 else None
+    if selected is not None and node_id is not None and slot is not None:
+        assign_slot(node_id, slot, selected.name)
+    return selected
+
+
+async def wait_for_study(
+    timeout: float, node_id: str | None = None, slot: int | None = None
+) -> CodeBaseStudy | None:
+    """Select a study, waiting up to `timeout` seconds for one to become eligible"""
+    global _studies_changed_loop
+    loop = _studies_changed_loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        # Taken before selecting so a change in between is not missed
+        changed = _studies_changed
+        # Off the event loop, selecting may wait on the database locks
+        selected = await asyncio.to_thread(select_single_study, node_id, slot)
+        remaining = deadline - loop.time()
+        if selected is not None or remaining <= 0:
+            return selected
+        try:
+            await asyncio.wait_for(
+                changed.wait(), timeout=min(remaining, STUDY_RECHECK_SECONDS)
+            )
+        except TimeoutError:
+            pass
 
 
 def activate_study(name: str) -> CodeBaseStudy:
     study = find_study_by_name(name)
     study.state = "running"
     update_study(study)
+    _notify_studies_changed()
     return study
 
 
@@ -81,24 +204,158 @@ def pause_study(name: str) -> CodeBaseStudy:
     return study
 
 
+def update_study_scheduling(name: str, scheduling: StudyScheduling) -> CodeBaseStudy:
+    study = find_study_by_name(name)
+    study.scheduling = scheduling
+    update_study(study)
+    _notify_studies_changed()
+    rebalance_studies()
+    return study
+
+
+def rebalance_studies() -> int:
+    """
+    Move busy slots from running studies above their share of the fleet to
+    eligible studies below it. A moved slot finishes its current trial first.
+
+    Returns the number of slots that were told to switch.
+    """
+    studies = {study.name: study for study in find_studies_by_state("running")}
+    busy = [
+        (node, slot)
+        for node in get_all_nodes()
+        for slot in node.slots
+        if slot.status != "idle" and slot.study_name in studies
+    ]
+    total_priority = sum(study.scheduling.priority for study in studies.values())
+    if len(busy) == 0 or total_priority <= 0:
+        return 0
+
+    def fair_share(study: CodeBaseStudy) -> float:
+        return len(busy) * study.scheduling.priority / total_priority
+
+    assignments = Counter(slot.study_name for _, slot in busy)
+    switched = 0
+    for node, slot in busy:
+        current = studies[slot.study_name]
+        if assignments[current.name] - 1 < fair_share(current):
+            continue
+        context = SchedulingContext(
+            node=node, assignments=assignments, count_trials=_count_trials
+        )
+        targets = [
+            study
+            for study in studies.values()
+            if assignments[study.name] + 1 <= fair_share(study)
+            and is_eligible(study, context)
+        ]
+        if len(targets) == 0:
+            continue
+        target = min(
+            targets,
+            key=lambda study: (
+                assignments[study.name] / max(study.scheduling.priority, 1e-9)
+            ),
+        )
+        queue_command(
+            node.id,
+            NodeCommand(kind="switch_study", slot=slot.index, study_name=target.name),
+        )
+        assignments[current.name] -= 1
+        assignments[target.name] += 1
+        switched += 1
+    return switched
+
+
 def get_study_codebase_zip(name: str) -> Path:
-    return _get_studies_dir() / name / "data.zip"
+    study = find_study_by_name(name)
+    if study.codebase_hash is None:
+        return _get_studies_dir() / name / "data.zip"
+    return _get_codebases_dir() / f"{study.codebase_hash}.zip"
+
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _write_chunk(buffer: IO[bytes], digest: hashlib._Hash, chunk: bytes) -> None:
+    digest.update(chunk)
+    buffer.write(chunk)
+
 
+async def store_codebase_zip(data: UploadFile) -> str:
+    """
+    Stream an uploaded code base zip to disk under its sha256 and return the hash,
+    hashing and writing happen off the event loop
+    """
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(
+        dir=_get_codebases_dir(), suffix=".part", delete=False
+    ) as buffer:
+        try:
+            while chunk := await data.read(UPLOAD_CHUNK_SIZE):
+                await asyncio.to_thread(_write_chunk, buffer, digest, chunk)
+        except BaseException:
+            buffer.close()
+            Path(buffer.name).unlink(missing_ok=True)
+            raise
 
-def store_codebase_zip(
-    name: str,
-    data: UploadFile,
-) -> Path:
+    codebase_hash = digest.hexdigest()
+    # Identical uploads end up as the same artifact
+    Path(buffer.name).replace(_get_codebases_dir() / f"{codebase_hash}.zip")
+    return codebase_hash
+
+
+def unpack_codebase(name: str, codebase_hash: str) -> Path:
+    """
+    Unpack a code base next to the study directory, the study keeps its current
+    code base until the new one is validated and moved in place
+    """
+    # Study names are alphanumeric, a leading dot never collides with one
+    unpacked_dir = Path(tempfile.mkdtemp(dir=_get_studies_dir(), prefix=f".{name}-"))
+    try:
+        extract_zip(_get_codebases_dir() / f"{codebase_hash}.zip", unpacked_dir)
+    except BaseException:
+        discard_unpacked_codebase(unpacked_dir)
+        raise
+    return unpacked_dir
+
+
+def discard_unpacked_codebase(unpacked_dir: Path) -> None:
+    shutil.rmtree(unpacked_dir, ignore_errors=True)
+
+
+def mark_codebase_valid(name: str, codebase_hash: str, unpacked_dir: Path) -> None:
+    """Replace the study directory with a validated unpacked code base"""
+    (unpacked_dir / CODEBASE_HASH_FILE).write_text(codebase_hash)
     study_dir = _get_studies_dir() / name
+    if not study_dir.exists():
+        unpacked_dir.rename(study_dir)
+        return
+    replaced_dir = unpacked_dir.with_name(f"{unpacked_dir.name}.replaced")
+    study_dir.rename(replaced_dir)
+    unpacked_dir.rename(study_dir)
+    shutil.rmtree(replaced_dir, ignore_errors=True)
 
-    # Clear directory if exists
-    if study_dir.exists():
-        shutil.rmtree(study_dir)
-    study_dir.mkdir(parents=True)
 
-    # Save the uploaded zip file to the study directory as data.zip
-    zip_path = study_dir / "data.zip"
-    with open(zip_path, "wb") as buffer:
-        shutil.copyfileobj(data.file, buffer)
+def get_unpacked_codebase_hash(name: str) -> str | None:
+    hash_file = _get_studies_dir() / name / CODEBASE_HASH_FILE
+    if not hash_file.exists():
+        return None
+    return hash_file.read_text().strip()
 
-    return zip_path
+
+def _apply_codebase_config(study: CodeBaseStudy) -> None:
+    # How the objective is called is part of the validated code base, not the request
+    config = check_config_file(_get_studies_dir() / study.name)
+    if config:
+        study.objective_mode = config.objective_mode
+        study.batch_size = config.batch_size
+
+
+def update_study_codebase(name: str, codebase_hash: str) -> CodeBaseStudy:
+    """Switch a study to a new code base, along with how its objective is called"""
+    study = find_study_by_name(name)
+    study.codebase_hash = codebase_hash
+    _apply_codebase_config(study)
+    update_study(study)
+    return study
@@ -0,0 +1,70 @@
+from collections import defaultdict
+
+from dobu_manager.config import OrchestratorConfig
+from dobu_manager.repositories.optuna_repository import (
+    get_storage,
+    get_study_id_of_trial,
+)
+from dobu_manager.repositories.timeline_repository import (
+    delete_timelines_beyond,
+    delete_timelines_of_deleted_studies,
+    find_timelines_by_study,
+    upsert_timeline,
+)
+from shared.models.timeline import (
+    PhaseSummary,
+    StudyTimelineSummary,
+    TrialTimeline,
+    percentile,
+)
+
+
+def record_timeline(trial_id: int, timeline: TrialTimeline) -> None:
+    upsert_timeline(trial_id, get_study_id_of_trial(trial_id), timeline)
+
+
+def prune_timelines() -> int:
+    """
+    Drop the timelines of deleted studies and all but the latest
+    `max_timelines_per_study` of the others, returns how many were dropped
+    """
+    study_ids = [study._study_id for study in get_storage().get_all_studies()]
+    deleted = delete_timelines_of_deleted_studies(study_ids)
+    return deleted + delete_timelines_beyond(
+        OrchestratorConfig.get().max_timelines_per_study
+    )
+
+
+def _summarize(samples: list[float]) -> PhaseSummary:
+    ordered = sorted(samples)
+    total = sum(ordered)
+    return PhaseSummary(
+        count=len(ordered),
+        total_seconds=total,
+        mean_seconds=total / len(ordered),
+        p50_seconds=percentile(ordered, 0.5),
+        p95_seconds=percentile(ordered, 0.95),
+    )
+
+
+def summarize_study(study_id: int) -> StudyTimelineSummary:
+    """Aggregate the timelines of all traced trials of a study per phase"""
+    timelines = find_timelines_by_study(study_id)
+    phases: dict[str, list[float]] = defaultdict(list)
+    round_trips: dict[str, list[float]] = defaultdict(list)
+    for timeline in timelines:
+        for phase, seconds in timeline.phases.items():
+            phases[phase].append(seconds)
+        for round_trip in timeline.round_trips:
+            round_trips[round_trip.operation].append(round_trip.seconds)
+
+    traced = sum(sum(samples) for samples in phases.values())
+    objective = sum(phases.get("objective", []))
+    return StudyTimelineSummary(
+        trials=len(timelines),
+        phases={phase: _summarize(samples) for phase, samples in phases.items()},
+        round_trips={
+            operation: _summarize(samples) for operation, samples in round_trips.items()
+        },
+        objective_fraction=objective / traced if traced > 0 else 0.0,
+    )
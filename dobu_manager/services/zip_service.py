@@ -5,8 +5,8 @@ from pathlib import Path
 from loguru import logger
 
 
-def extract_zip(zip_path: Path) -> Path:
-    target_dir = zip_path.parent
+def extract_zip(zip_path: Path, target_dir: Path | None = None) -> Path:
+    target_dir = zip_path.parent if target_dir is None else target_dir
     with zipfile.ZipFile(zip_path, "r") as zip:
         size = sum([zip_info.file_size for zip_info in zip.filelist])
         logger.info(f"Extracting code-base [{(size / 10e6):.2f} MB] to {target_dir}")
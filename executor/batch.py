@@ -0,0 +1,73 @@
+from typing import Sequence
+
+import numpy as np
+import optuna
+from optuna.distributions import CategoricalChoiceType
+
+
+class TrialBatch:
+    """
+    The argument of a batch objective, declared with `"objective_mode": "batch"`
+    in kodu-optim.json. Every suggestion returns an array with one value per
+    trial, so the objective can evaluate the whole batch in one vectorized call:
+
+        def objective(batch: TrialBatch) -> np.ndarray:
+            x = batch.suggest_float("x", -10, 10)
+            return x**2
+
+    The objective returns one value per trial, or one row of values per trial
+    for a multi-objective study. A NaN fails only the trial it belongs to.
+    """
+
+    def __init__(self, trials: list[optuna.Trial]):
+        self.trials = trials
+        """The trials of the batch, in the order of the arrays"""
+
+    def __len__(self) -> int:
+        return len(self.trials)
+
+    @property
+    def numbers(self) -> np.ndarray:
+        return np.array([trial.number for trial in self.trials])
+
+    def suggest_float(
+        self,
+        name: str,
+        low: float,
+        high: float,
+        *,
+        step: float | None = None,
+        log: bool = False,
+    ) -> np.ndarray:
+        return np.array(
+            [
+                trial.suggest_float(name, low, high, step=step, log=log)
+                for trial in self.trials
+            ],
+            dtype=float,
+        )
+
+    def suggest_int(
+        self, name: str, low: int, high: int, *, step: int = 1, log: bool = False
+    ) -> np.ndarray:
+        return np.array(
+            [
+                trial.suggest_int(name, low, high, step=step, log=log)
+                for trial in self.trials
+            ],
+            dtype=int,
+        )
+
+    def suggest_categorical(
+        self, name: str, choices: Sequence[CategoricalChoiceType]
+    ) -> np.ndarray:
+        values = [trial.suggest_categorical(name, choices) for trial in self.trials]
+        # Keep the choices as they are, numpy would turn mixed choices into strings
+        array = np.empty(len(values), dtype=object)
+        array[:] = values
+        return array
+
+    def set_user_attr(self, key: str, values: Sequence) -> None:
+        """Set a user attribute per trial, `values` holds one value per trial"""
+        for trial, value in zip(self.trials, values, strict=True):
+            trial.set_user_attr(key, value)
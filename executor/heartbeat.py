@@ -0,0 +1,64 @@
+import os
+import threading
+import time
+from pathlib import Path
+
+import optuna
+
+from shared.models.executor import ExecutorStatus
+
+
+class Heartbeat:
+    """
+    Periodically writes the status of the executor to a file, so the worker can
+    kill trials that hang or run past their timeout.
+
+    A background thread keeps beating while the objective runs, a file that
+    stops changing means the whole process is stuck.
+    """
+
+    def __init__(self, status_file: Path, interval: float):
+        self.status_file = status_file
+        self.interval = interval
+        self._status = ExecutorStatus(heartbeat_at=time.time())
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="executor-heartbeat", daemon=True
+        )
+
+    def start(self) -> None:
+        self._write()
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def start_trial(self, trial: optuna.Trial) -> None:
+        with self._lock:
+            self._status = ExecutorStatus(
+                heartbeat_at=time.time(),
+                trial_id=trial._trial_id,
+                trial_number=trial.number,
+                trial_started_at=time.time(),
+            )
+        self._write()
+
+    def end_trial(self) -> None:
+        with self._lock:
+            self._status = ExecutorStatus(heartbeat_at=time.time())
+        self._write()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self._write()
+
+    def _write(self) -> None:
+        with self._lock:
+            self._status.heartbeat_at = time.time()
+            content = self._status.model_dump_json()
+            # Replace atomically, the worker never reads a partial file
+            partial_file = self.status_file.with_suffix(".partial")
+            partial_file.write_text(content)
+            os.replace(partial_file, self.status_file)
@@ -1,15 +1,29 @@
 import argparse
+import functools
 import importlib
+import json
 import logging
+import math
 import os
+import signal
 import sys
+import time
 from pathlib import Path
+from typing import Callable, Sequence
 
+import aiohttp
+import numpy as np
 import optuna
+from optuna.trial import TrialState
 
 # sys.path.insert(0, Path(__file__).parent.parent.as_posix())
 # print(sys.path)
+from executor.batch import TrialBatch
+from executor.heartbeat import Heartbeat
+from executor.rest_pruner import RestPruner
 from executor.rest_storage import RestStorage
+from executor.timeline import Timeline
+from shared.models.optuna import OptunaTrialResult
 
 logger = logging.getLogger("[EXECUTOR]")
 logger.setLevel(logging.INFO)
@@ -21,9 +35,47 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 
+class StopSignal:
+    """Lets the worker ask a resident executor to stop after the current trial"""
+
+    def __init__(self):
+        self.requested = False
+        signal.signal(signal.SIGTERM, self._handle)
+
+    def _handle(self, signum, frame):
+        logger.info("Received stop signal, finishing the current trial")
+        self.requested = True
+
+
 def main(
-    objective_function: str, objective_file: str, study_name: str, storage_url: str
+    objective_function: str,
+    objective_file: str,
+    study_name: str,
+    storage_url: str,
+    n_trials: int | None = 1,
+    timeout: float | None = None,
+    http_pool_size: int = 4,
+    http_timeout: float = 30.0,
+    server_ask: bool = False,
+    worker_phases: dict[str, float] | None = None,
+    spawned_at: float | None = None,
+    node_id: str | None = None,
+    status_file: Path | None = None,
+    heartbeat_interval: float = 5.0,
+    lease_size: int = 1,
+    lease_seconds: float = 300.0,
+    objective_mode: str = "single",
 ):
+    heartbeat = None
+    if status_file is not None:
+        heartbeat = Heartbeat(status_file, heartbeat_interval)
+        heartbeat.start()
+
+    # The phases the worker went through to start this process come first
+    timeline = Timeline(worker_phases)
+    if spawned_at is not None:
+        timeline.phases["spawn"] = max(0.0, time.time() - spawned_at)
+
     project_dir = Path(os.getcwd())
     logger.info(
         f"Looking for {objective_function} in {objective_file} at {project_dir.as_posix()}"
@@ -33,7 +85,8 @@ def main(
         logger.info(f"Adding {project_dir.as_posix()} to sys.path")
         sys.path.insert(0, project_dir.as_posix())
 
-    module = importlib.import_module(name=objective_file.removesuffix(".py"))
+    with timeline.phase("import"):
+        module = importlib.import_module(name=objective_file.removesuffix(".py"))
     logger.info(f"Successfully import module {module.__name__} from {objective_file}")
     logger.info(
         f"The imported module has the following attributes {[key for key in module.__dict__.keys() if key not in ['__name__', '__doc__', '__package__', '__loader__', '__spec__', '__file__', '__cached__', '__builtins__']]}"
@@ -43,16 +96,379 @@ def main(
 
     logger.info("Successfully imported the object function")
     logger.info("Loading study from optuna")
-    storage = RestStorage(storage_url)
-    study = optuna.load_study(study_name=study_name, storage=storage)
+    storage = RestStorage(
+        storage_url, pool_size=http_pool_size, timeout=http_timeout, node_id=node_id
+    )
+    try:
+        with timeline.phase("load_study"):
+            if server_ask or lease_size > 1 or objective_mode == "batch":
+                # Parameters outside the server sampled search space are sampled
+                # locally, randomly so that no trial history has to be downloaded
+                study = optuna.load_study(
+                    study_name=study_name,
+                    storage=storage,
+                    sampler=optuna.samplers.RandomSampler(),
+                    pruner=RestPruner(storage),
+                )
+                ask = functools.partial(ask_server_side, study, storage)
+            else:
+                study = optuna.load_study(
+                    study_name=study_name, storage=storage, pruner=RestPruner(storage)
+                )
+                ask = study.ask
+        if lease_size > 1 or objective_mode == "batch":
+            finished_trials = run_leased_trials(
+                study,
+                storage,
+                objective,
+                lease_size,
+                lease_seconds,
+                n_trials,
+                timeout,
+                timeline,
+                heartbeat,
+                batch=objective_mode == "batch",
+            )
+        else:
+            finished_trials = run_trials(
+                study, storage, objective, ask, n_trials, timeout, timeline, heartbeat
+            )
+    finally:
+        storage.close()
+        if heartbeat is not None:
+            heartbeat.stop()
+
+    logger.info(f"Finished execution after {finished_trials} trial(s)")
+
+
+def ask_server_side(study: optuna.Study, storage: RestStorage) -> optuna.Trial:
+    frozen_trial = storage.ask_trial(study._study_id)
+    return optuna.Trial(study, frozen_trial._trial_id)
+
+
+def _is_budget_exhausted(error: aiohttp.ClientResponseError) -> bool:
+    # The orchestrator refuses new trials once a study used up its budget
+    return error.status == 409
+
 
-    logger.info(f"Creating trial for study {study_name}")
-    trial = study.ask()
+def run_trials(
+    study: optuna.Study,
+    storage: RestStorage,
+    objective,
+    ask: Callable[[], optuna.Trial],
+    n_trials: int | None,
+    timeout: float | None,
+    process_timeline: Timeline,
+    heartbeat: Heartbeat | None = None,
+) -> int:
+    stop_signal = StopSignal()
+    started_at = time.monotonic()
+    finished_trials = 0
+    while True:
+        if stop_signal.requested:
+            logger.info("Stopping on request of the worker")
+            break
+        if n_trials is not None and finished_trials >= n_trials:
+            logger.info(f"Reached the trial budget of {n_trials}")
+            break
+        if timeout is not None and time.monotonic() - started_at >= timeout:
+            logger.info(f"Reached the wall-clock budget of {timeout} seconds")
+            break
+
+        # Only the first trial pays for starting the process
+        timeline = process_timeline if finished_trials == 0 else Timeline()
+        try:
+            run_trial(study, storage, objective, ask, timeline, heartbeat)
+        except aiohttp.ClientResponseError as e:
+            if not _is_budget_exhausted(e):
+                raise
+            logger.info("The study reached its trial budget")
+            break
+        finished_trials += 1
+    return finished_trials
+
+
+def run_trial(
+    study: optuna.Study,
+    storage: RestStorage,
+    objective,
+    ask: Callable[[], optuna.Trial],
+    timeline: Timeline,
+    heartbeat: Heartbeat | None = None,
+) -> None:
+    logger.info(f"Creating trial for study {study.study_name}")
+    with timeline.phase("ask"):
+        trial = ask()
     logger.info(f"Starting trial {trial.number}")
-    result = objective(trial)
-    logger.info(f"Trial finished with score: {result}")
-    study.tell(trial, result)
-    logger.info("Finished execution")
+    if heartbeat is not None:
+        heartbeat.start_trial(trial)
+    try:
+        try:
+            with timeline.phase("objective"):
+                result = objective(trial)
+        except optuna.TrialPruned:
+            logger.info(f"Trial {trial.number} was pruned")
+            with timeline.phase("tell"):
+                study.tell(trial, state=TrialState.PRUNED)
+            return
+        except Exception:
+            logger.exception(f"Trial {trial.number} failed")
+            with timeline.phase("tell"):
+                study.tell(trial, state=TrialState.FAIL)
+            raise
+        logger.info(f"Trial finished with score: {result}")
+        with timeline.phase("tell"):
+            study.tell(trial, result)
+    finally:
+        if heartbeat is not None:
+            heartbeat.end_trial()
+        # Goes out with the next request, the trial may already be finished
+        storage.set_trial_timeline(
+            trial._trial_id, timeline.to_model(storage.take_round_trips())
+        )
+
+
+def run_leased_trials(
+    study: optuna.Study,
+    storage: RestStorage,
+    objective,
+    lease_size: int,
+    lease_seconds: float,
+    n_trials: int | None,
+    timeout: float | None,
+    process_timeline: Timeline,
+    heartbeat: Heartbeat | None = None,
+    batch: bool = False,
+) -> int:
+    """
+    Like `run_trials`, but asks `lease_size` trials per request and tells them
+    in one request as well, for objectives that take less time than a round trip.
+    A `batch` objective gets all trials of a lease in a single call.
+    """
+    stop_signal = StopSignal()
+    started_at = time.monotonic()
+    finished_trials = 0
+    while True:
+        if stop_signal.requested:
+            logger.info("Stopping on request of the worker")
+            break
+        if n_trials is not None and finished_trials >= n_trials:
+            logger.info(f"Reached the trial budget of {n_trials}")
+            break
+        if timeout is not None and time.monotonic() - started_at >= timeout:
+            logger.info(f"Reached the wall-clock budget of {timeout} seconds")
+            break
+
+        count = lease_size
+        if n_trials is not None:
+            count = min(count, n_trials - finished_trials)
+        timeline = process_timeline if finished_trials == 0 else Timeline()
+        run = run_batch if batch else run_lease
+        try:
+            finished_trials += run(
+                study, storage, objective, count, lease_seconds, timeline, heartbeat
+            )
+        except aiohttp.ClientResponseError as e:
+            if not _is_budget_exhausted(e):
+                raise
+            logger.info("The study reached its trial budget")
+            break
+    return finished_trials
+
+
+def _values_of(study: optuna.Study, result) -> list[float] | None:
+    """The values to tell for an objective result, None if it is not valid"""
+    values = list(result) if isinstance(result, Sequence) else [result]
+    try:
+        values = [float(value) for value in values]
+    except (TypeError, ValueError):
+        return None
+    if len(values) != len(study.directions) or any(map(math.isnan, values)):
+        return None
+    return values
+
+
+def tell_results(
+    study: optuna.Study, storage: RestStorage, results: list[OptunaTrialResult]
+) -> int:
+    """
+    Tell a batch of leased trials, returns how many were accepted. The others
+    were finished by the orchestrator, usually because their lease expired and
+    their parameters went back to the study.
+    """
+    did_update = storage.tell_trials(study._study_id, results)
+    rejected = [
+        result.trial_id for result, updated in zip(results, did_update) if not updated
+    ]
+    if len(rejected) > 0:
+        logger.warning(
+            f"The orchestrator rejected the results of {len(rejected)} trial(s)"
+            f" {rejected}, raise the lease time if their lease expired"
+        )
+    return len(results) - len(rejected)
+
+
+def run_lease(
+    study: optuna.Study,
+    storage: RestStorage,
+    objective,
+    count: int,
+    lease_seconds: float,
+    timeline: Timeline,
+    heartbeat: Heartbeat | None = None,
+) -> int:
+    """
+    Lease `count` trials, evaluate them one after the other and tell them all at
+    once. The first trial carries the lease and tell phases of the whole batch.
+
+    A failing objective ends the lease early. The results so far are told, the
+    trials that were not evaluated expire and go back to the study.
+    """
+    logger.info(f"Leasing {count} trial(s) for study {study.study_name}")
+    with timeline.phase("lease"):
+        frozen_trials = storage.lease_trials(study._study_id, count, lease_seconds)
+
+    results: list[OptunaTrialResult] = []
+    timelines: dict[int, Timeline] = {}
+    try:
+        for frozen_trial in frozen_trials:
+            trial = optuna.Trial(study, frozen_trial._trial_id)
+            trial_timeline = timeline if len(timelines) == 0 else Timeline()
+            timelines[trial._trial_id] = trial_timeline
+            if heartbeat is not None:
+                heartbeat.start_trial(trial)
+            try:
+                with trial_timeline.phase("objective"):
+                    result = objective(trial)
+            except optuna.TrialPruned:
+                logger.info(f"Trial {trial.number} was pruned")
+                results.append(
+                    OptunaTrialResult(
+                        trial_id=trial._trial_id, state=TrialState.PRUNED, values=None
+                    )
+                )
+                continue
+            except Exception:
+                logger.exception(f"Trial {trial.number} failed")
+                results.append(
+                    OptunaTrialResult(
+                        trial_id=trial._trial_id, state=TrialState.FAIL, values=None
+                    )
+                )
+                raise
+            finally:
+                if heartbeat is not None:
+                    heartbeat.end_trial()
+
+            logger.info(f"Trial {trial.number} finished with score: {result}")
+            values = _values_of(study, result)
+            state = TrialState.COMPLETE
+            if values is None:
+                logger.warning(f"Trial {trial.number} returned {result!r}, failing it")
+                state = TrialState.FAIL
+            results.append(
+                OptunaTrialResult(trial_id=trial._trial_id, state=state, values=values)
+            )
+    finally:
+        if len(results) > 0:
+            with timeline.phase("tell"):
+                tell_results(study, storage, results)
+        round_trips = storage.take_round_trips()
+        # Go out with the next request, the trials are already finished
+        for trial_id, trial_timeline in timelines.items():
+            storage.set_trial_timeline(trial_id, trial_timeline.to_model(round_trips))
+            round_trips = []
+    return len(results)
+
+
+def _failed_results(trials: list[optuna.Trial]) -> list[OptunaTrialResult]:
+    return [
+        OptunaTrialResult(trial_id=trial._trial_id, state=TrialState.FAIL, values=None)
+        for trial in trials
+    ]
+
+
+def _batch_results(
+    study: optuna.Study, trials: list[optuna.Trial], result
+) -> list[OptunaTrialResult]:
+    """One result per trial from the array a batch objective returned"""
+    try:
+        values = np.asarray(result, dtype=float)
+    except (TypeError, ValueError):
+        values = None
+    shape = (len(trials),)
+    if len(study.directions) > 1:
+        shape = (len(trials), len(study.directions))
+    if values is None or values.shape != shape:
+        logger.warning(
+            f"Batch objective returned {result!r}, expected an array of shape"
+            f" {shape}, failing the batch"
+        )
+        return _failed_results(trials)
+
+    values = values.reshape(len(trials), -1)
+    results = []
+    for trial, row in zip(trials, values):
+        if np.isnan(row).any():
+            logger.warning(f"Trial {trial.number} returned NaN, failing it")
+            results.extend(_failed_results([trial]))
+        else:
+            results.append(
+                OptunaTrialResult(
+                    trial_id=trial._trial_id,
+                    state=TrialState.COMPLETE,
+                    values=row.tolist(),
+                )
+            )
+    return results
+
+
+def run_batch(
+    study: optuna.Study,
+    storage: RestStorage,
+    objective,
+    count: int,
+    lease_seconds: float,
+    timeline: Timeline,
+    heartbeat: Heartbeat | None = None,
+) -> int:
+    """
+    Lease `count` trials, evaluate them in one call of a batch objective and
+    tell them all at once. Only the first trial carries a timeline, it covers
+    the whole batch.
+
+    The trial timeout of the study applies to the whole call, the heartbeat
+    reports the first trial of the batch.
+    """
+    logger.info(f"Leasing a batch of {count} trial(s) for study {study.study_name}")
+    with timeline.phase("lease"):
+        frozen_trials = storage.lease_trials(study._study_id, count, lease_seconds)
+    trials = [optuna.Trial(study, trial._trial_id) for trial in frozen_trials]
+    if len(trials) == 0:
+        return 0
+
+    results: list[OptunaTrialResult] = []
+    if heartbeat is not None:
+        heartbeat.start_trial(trials[0])
+    try:
+        with timeline.phase("objective"):
+            result = objective(TrialBatch(trials))
+        results = _batch_results(study, trials, result)
+    except Exception:
+        logger.exception(f"Batch starting at trial {trials[0].number} failed")
+        results = _failed_results(trials)
+        raise
+    finally:
+        if heartbeat is not None:
+            heartbeat.end_trial()
+        if len(results) > 0:
+            with timeline.phase("tell"):
+                tell_results(study, storage, results)
+        storage.set_trial_timeline(
+            trials[0]._trial_id, timeline.to_model(storage.take_round_trips())
+        )
+    logger.info(f"Finished a batch of {len(trials)} trial(s)")
+    return len(trials)
 
 
 def cli_parser():
@@ -61,6 +477,83 @@ def cli_parser():
     parser.add_argument("--objective-function", type=str, required=True)
     parser.add_argument("--storage", type=str, required=True)
     parser.add_argument("--study-name", type=str, required=True)
+    parser.add_argument(
+        "--n-trials",
+        type=int,
+        default=1,
+        help="The number of trials to run before exiting, 0 means no limit",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="Stop starting new trials after this many seconds",
+    )
+    parser.add_argument(
+        "--http-pool-size",
+        type=int,
+        default=4,
+        help="The number of keep-alive connections to the orchestrator",
+    )
+    parser.add_argument(
+        "--http-timeout",
+        type=float,
+        default=30.0,
+        help="The total timeout in seconds of a single storage request",
+    )
+    parser.add_argument(
+        "--server-ask",
+        action="store_true",
+        help="Let the orchestrator sample the parameters of every trial",
+    )
+    parser.add_argument(
+        "--worker-phases",
+        type=json.loads,
+        default=None,
+        help="JSON object with the seconds the worker spent per phase before spawning",
+    )
+    parser.add_argument(
+        "--spawned-at",
+        type=float,
+        default=None,
+        help="The unix time at which the worker spawned this process",
+    )
+    parser.add_argument(
+        "--node-id",
+        type=str,
+        default=None,
+        help="The worker node this process runs on",
+    )
+    parser.add_argument(
+        "--status-file",
+        type=Path,
+        default=None,
+        help="Keep the status of the running trial in this file for the worker",
+    )
+    parser.add_argument(
+        "--heartbeat-interval",
+        type=float,
+        default=5.0,
+        help="How often the status file is refreshed, in seconds",
+    )
+    parser.add_argument(
+        "--lease-size",
+        type=int,
+        default=1,
+        help="Lease this many server sampled trials at once and tell them together",
+    )
+    parser.add_argument(
+        "--lease-seconds",
+        type=float,
+        default=300.0,
+        help="Leased trials that are not told within this time go back to the study",
+    )
+    parser.add_argument(
+        "--objective-mode",
+        choices=["single", "batch"],
+        default="single",
+        help="A batch objective evaluates all trials of a lease in a single call",
+    )
 
     args = parser.parse_args()
     return args
@@ -73,6 +566,19 @@ def entrypoint():
         objective_function=args.objective_function,
         storage_url=args.storage,
         study_name=args.study_name,
+        n_trials=args.n_trials or None,
+        timeout=args.timeout,
+        http_pool_size=args.http_pool_size,
+        http_timeout=args.http_timeout,
+        server_ask=args.server_ask,
+        worker_phases=args.worker_phases,
+        spawned_at=args.spawned_at,
+        node_id=args.node_id,
+        status_file=args.status_file,
+        heartbeat_interval=args.heartbeat_interval,
+        lease_size=args.lease_size,
+        lease_seconds=args.lease_seconds,
+        objective_mode=args.objective_mode,
     )
 
 
@@ -84,4 +590,17 @@ if __name__ == "__main__":
         objective_function=args.objective_function,
         storage_url=args.storage,
         study_name=args.study_name,
+        n_trials=args.n_trials or None,
+        timeout=args.timeout,
+        http_pool_size=args.http_pool_size,
+        http_timeout=args.http_timeout,
+        server_ask=args.server_ask,
+        worker_phases=args.worker_phases,
+        spawned_at=args.spawned_at,
+        node_id=args.node_id,
+        status_file=args.status_file,
+        heartbeat_interval=args.heartbeat_interval,
+        lease_size=args.lease_size,
+        lease_seconds=args.lease_seconds,
+        objective_mode=args.objective_mode,
     )
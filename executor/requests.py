@@ -1,4 +1,6 @@
-from typing import Literal, Type, TypeVar
+import asyncio
+import threading
+from typing import Coroutine, Literal, Type, TypeVar
 
 import aiohttp
 from pydantic import BaseModel
@@ -9,31 +11,90 @@ T = TypeVar("T", bound=BaseModel)
 
 
 async def request(
-    url: str, method: HTTPMethod, data: BaseModel | None, result_type: Type[T]
-) -> T:
-    raw = data.model_dump(mode="json") if data is not None else {}
-    async with aiohttp.ClientSession() as session:
-        if method == "GET":
-            result = await session.get(url)
-        elif method == "PUT":
-            result = await session.put(
-                url,
-                json=raw,
-                headers={"content-type": "application/json"},
-            )
+    session: aiohttp.ClientSession,
+    url: str,
+    method: HTTPMethod,
+    data: BaseModel | None,
+    result_type: Type[T] | None,
+) -> T | None:
+    if method not in ("GET", "PUT", "POST", "DELETE"):
+        raise ValueError(f"Unsupported HTTP method: {method}")
 
-        elif method == "POST":
-            result = await session.post(
-                url,
-                json=raw,
-                headers={"content-type": "application/json"},
-            )
-        elif method == "DELETE":
-            result = await session.get(url)
-        else:
-            raise ValueError(f"Unsupported HTTP method: {method}")
+    kwargs = {}
+    if method in ("PUT", "POST"):
+        kwargs["json"] = data.model_dump(mode="json") if data is not None else {}
+        kwargs["headers"] = {"content-type": "application/json"}
 
+    async with session.request(method, url, **kwargs) as result:
         result.raise_for_status()
         if result_type is None:
+            # Drain the body so the connection can go back to the pool
+            await result.read()
             return None
-    return result_type.model_validate(await result.json())
+        return result_type.model_validate(await result.json())
+
+
+class Transport:
+    """
+    A keep-alive HTTP client for synchronous callers.
+
+    One `aiohttp.ClientSession` and its connection pool live on an event loop
+    owned by a background thread, so every call reuses the same loop and
+    connections instead of paying for a new loop and socket each time.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 4,
+        timeout: float = 30.0,
+        connect_timeout: float = 5.0,
+        keepalive_timeout: float = 60.0,
+        headers: dict[str, str] | None = None,
+    ):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="rest-storage-transport", daemon=True
+        )
+        self._thread.start()
+        self._session: aiohttp.ClientSession = self._run(
+            self._create_session(
+                pool_size=pool_size,
+                timeout=aiohttp.ClientTimeout(total=timeout, connect=connect_timeout),
+                keepalive_timeout=keepalive_timeout,
+                headers=headers,
+            )
+        )
+
+    @staticmethod
+    async def _create_session(
+        pool_size: int,
+        timeout: aiohttp.ClientTimeout,
+        keepalive_timeout: float,
+        headers: dict[str, str] | None,
+    ) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=pool_size, keepalive_timeout=keepalive_timeout
+        )
+        return aiohttp.ClientSession(
+            connector=connector, timeout=timeout, headers=headers
+        )
+
+    def _run[R](self, coroutine: Coroutine[None, None, R]) -> R:
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def request(
+        self,
+        url: str,
+        method: HTTPMethod,
+        data: BaseModel | None,
+        result_type: Type[T] | None,
+    ) -> T | None:
+        return self._run(request(self._session, url, method, data, result_type))
+
+    def close(self) -> None:
+        if self._loop.is_closed():
+            return
+        self._run(self._session.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
@@ -0,0 +1,20 @@
+from typing import override
+
+import optuna
+from optuna.pruners import BasePruner
+
+from executor.rest_storage import RestStorage
+
+
+class RestPruner(BasePruner):
+    """
+    A pruner that defers to the pruner configured for the study on the
+    Koko Orchestrator, so the trial history never has to be downloaded
+    """
+
+    def __init__(self, storage: RestStorage):
+        self.storage = storage
+
+    @override
+    def prune(self, study: optuna.Study, trial: optuna.trial.FrozenTrial) -> bool:
+        return self.storage.should_prune(study._study_id, trial._trial_id)
@@ -1,25 +1,64 @@
 import asyncio
+import copy
+import logging
+import re
+import threading
+import time
 from typing import Type, TypeVar, override
 
+import aiohttp
 import optuna
 from pydantic import BaseModel
 
-from executor.requests import HTTPMethod, request
+from executor.requests import HTTPMethod, Transport
+from shared.models.node import NODE_ID_HEADER
 from shared.models.optuna import (
+    OptunaAsk,
     OptunaGetAllTrials,
+    OptunaLease,
+    OptunaLeasedTrials,
     OptunaRequestStudyFromName,
-    OptunaSetParam,
-    OptunaSetValue,
-    OptunaSetValueResponse,
+    OptunaShouldPrune,
     OptunaStudyDirection,
     OptunaStudyIdFromName,
     OptunaStudyNameFromId,
+    OptunaTell,
+    OptunaTellResponse,
     OptunaTrial,
     OptunaTrialCreation,
+    OptunaTrialResult,
+    OptunaTrialWrite,
+    OptunaWriteAttr,
+    OptunaWriteBatch,
+    OptunaWriteBatchResponse,
+    OptunaWriteIntermediateValue,
+    OptunaWriteParam,
+    OptunaWriteStateValues,
+    OptunaWriteTimeline,
 )
+from shared.models.timeline import StorageRoundTrip, TrialTimeline
 
 T = TypeVar("wr", bound=BaseModel)
 
+logger = logging.getLogger("[EXECUTOR]")
+
+
+def _operation(method: HTTPMethod, path: str) -> str:
+    # Ids are replaced so that round trips aggregate per operation
+    template = re.sub(r"\d+", "{id}", path.split("?")[0])
+    return f"{method} {template}"
+
+
+def _distributions_to_json(
+    distributions: dict[str, optuna.distributions.BaseDistribution] | None,
+) -> dict[str, str] | None:
+    if distributions is None:
+        return None
+    return {
+        name: optuna.distributions.distribution_to_json(distribution)
+        for name, distribution in distributions.items()
+    }
+
 
 class RestStorage(optuna.storages.BaseStorage):
     """
@@ -27,10 +66,55 @@ class RestStorage(optuna.storages.BaseStorage):
     Koko Orchestrator
     """
 
-    def __init__(self, url: str):
+    def __init__(
+        self,
+        url: str,
+        pool_size: int = 4,
+        timeout: float = 30.0,
+        connect_timeout: float = 5.0,
+        keepalive_timeout: float = 60.0,
+        max_buffered_writes: int = 64,
+        flush_interval: float = 1.0,
+        node_id: str | None = None,
+    ):
         super().__init__()
         self.url = url
         """The fully fledge domain url to the orchestrator"""
+        self.node_id = node_id
+        """The worker node this executor runs on, lets it reclaim orphaned trials"""
+        self._transport = Transport(
+            pool_size=pool_size,
+            timeout=timeout,
+            connect_timeout=connect_timeout,
+            keepalive_timeout=keepalive_timeout,
+            headers={NODE_ID_HEADER: node_id} if node_id is not None else None,
+        )
+        self._trials_lock = threading.Lock()
+        self._trial_cache: dict[int, dict[int, optuna.trial.FrozenTrial]] = {}
+        """Per study the known trials by number"""
+        self._finished_prefix: dict[int, int] = {}
+        """Per study the number of leading trials that are cached and finished"""
+        self._asked_trials: dict[int, optuna.trial.FrozenTrial] = {}
+        """Trials returned by `ask_trial` that have not been read back yet"""
+        self.max_buffered_writes = max_buffered_writes
+        """Flush the write buffer once it holds this many writes"""
+        self.flush_interval = flush_interval
+        """Flush the write buffer at the latest this many seconds after a write"""
+        self._write_buffer: list[OptunaTrialWrite] = []
+        self._write_buffer_lock = threading.RLock()
+        self._flush_timer: threading.Timer | None = None
+        self._flush_error: Exception | None = None
+        """Why the last background flush failed, raised by the next storage call"""
+        self._round_trips: list[StorageRoundTrip] = []
+        """Requests made since the last call to `take_round_trips`"""
+        self._round_trips_lock = threading.Lock()
+
+    def close(self) -> None:
+        """Flush pending writes and close the pooled connections to the orchestrator"""
+        try:
+            self.flush()
+        finally:
+            self._transport.close()
 
     def _sent_request(
         self,
@@ -39,16 +123,123 @@ class RestStorage(optuna.storages.BaseStorage):
         body: BaseModel | None,
         result_type: Type[T] | None,
     ) -> T | None:
-        result: T | None = asyncio.run(
-            request(
+        # Every request may depend on buffered writes, so they go out first
+        self.flush()
+        return self._request(method, path, body, result_type)
+
+    def _request(
+        self,
+        method: HTTPMethod,
+        path: str,
+        body: BaseModel | None,
+        result_type: Type[T] | None,
+    ) -> T | None:
+        start = time.perf_counter()
+        try:
+            result: T | None = self._transport.request(
                 url=f"{self.url}/optuna/{path}",
                 method=method,
                 data=body,
                 result_type=result_type,
             )
-        )
+        finally:
+            round_trip = StorageRoundTrip(
+                operation=_operation(method, path),
+                seconds=time.perf_counter() - start,
+            )
+            with self._round_trips_lock:
+                self._round_trips.append(round_trip)
         return result
 
+    def take_round_trips(self) -> list[StorageRoundTrip]:
+        """The requests made to the orchestrator since the previous call"""
+        with self._round_trips_lock:
+            round_trips, self._round_trips = self._round_trips, []
+        return round_trips
+
+    def set_trial_timeline(self, trial_id: int, timeline: TrialTimeline) -> None:
+        """Report where a trial spent its time, sent along with the next writes"""
+        self._buffer_write(OptunaWriteTimeline(trial_id=trial_id, timeline=timeline))
+
+    def _buffer_write(self, write: OptunaTrialWrite) -> None:
+        if isinstance(write, OptunaWriteAttr):
+            # Fail at the call instead of in a later flush of the whole batch
+            write.model_dump(mode="json")
+        with self._write_buffer_lock:
+            self._raise_flush_error()
+            self._write_buffer.append(write)
+            if len(self._write_buffer) >= self.max_buffered_writes:
+                self.flush()
+            elif self._flush_timer is None:
+                self._flush_timer = threading.Timer(
+                    self.flush_interval, self._flush_in_background
+                )
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def _flush_in_background(self) -> None:
+        try:
+            self.flush()
+        except Exception as e:  # noqa: BLE001
+            self._flush_error = e
+
+    def _raise_flush_error(self) -> None:
+        error, self._flush_error = self._flush_error, None
+        if error is not None:
+            raise error
+
+    def flush(self) -> bool | None:
+        """
+        Send all buffered writes to the orchestrator in a single ordered batch.
+
+        Writes that were not applied go back into the buffer when a later
+        attempt can succeed, writes the orchestrator refused are logged. Raises
+        the error of a failed background flush.
+
+        Returns whether the last buffered state write updated its trial.
+        """
+        with self._write_buffer_lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            self._raise_flush_error()
+            if len(self._write_buffer) == 0:
+                return None
+
+            writes, self._write_buffer = self._write_buffer, []
+            try:
+                response = self._request(
+                    "POST",
+                    "trials/batch",
+                    OptunaWriteBatch(writes=writes),
+                    OptunaWriteBatchResponse,
+                )
+            except aiohttp.ClientResponseError as e:
+                if e.status < 500:
+                    # Sending the same batch again would be refused again
+                    logger.error(f"The orchestrator refused {len(writes)} write(s)")
+                    raise
+                self._write_buffer = writes + self._write_buffer
+                raise
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                # Keep the writes in order for the next attempt
+                self._write_buffer = writes + self._write_buffer
+                raise
+
+            for rejected in response.rejected:
+                write = writes[rejected.index]
+                logger.warning(
+                    f"The orchestrator refused a {write.kind} write to trial "
+                    f"{write.trial_id}: {rejected.detail}"
+                )
+            if response.stopped_at is not None:
+                self._write_buffer = writes[response.stopped_at :] + self._write_buffer
+                raise RuntimeError(
+                    f"The orchestrator applied {response.stopped_at} of "
+                    f"{len(writes)} write(s): {response.error}"
+                )
+            return response.did_update
+
     @override
     def create_new_study(self, directions, study_name=None):
         raise NotImplementedError
@@ -109,52 +300,149 @@ class RestStorage(optuna.storages.BaseStorage):
         )
         return response.trial_id
 
+    def ask_trial(
+        self,
+        study_id: int,
+        distributions: dict[str, optuna.distributions.BaseDistribution] | None = None,
+    ) -> optuna.trial.FrozenTrial:
+        """
+        Create a trial whose parameters are sampled by the orchestrator.
+
+        Without `distributions` the orchestrator samples the search space shared
+        by the finished trials of the study.
+        """
+        response = self._sent_request(
+            "POST",
+            f"study/{study_id}/ask",
+            OptunaAsk(distributions=_distributions_to_json(distributions)),
+            OptunaTrial,
+        )
+        trial = response.to_native()
+        # optuna.Trial reads the trial right after creation, serve it locally
+        self._asked_trials[trial._trial_id] = trial
+        return copy.deepcopy(trial)
+
+    def lease_trials(
+        self,
+        study_id: int,
+        count: int,
+        lease_seconds: float,
+        distributions: dict[str, optuna.distributions.BaseDistribution] | None = None,
+    ) -> list[optuna.trial.FrozenTrial]:
+        """
+        Create `count` trials sampled by the orchestrator in a single request.
+
+        They have to be finished together through `tell_trials` within
+        `lease_seconds`, the orchestrator fails and requeues the others.
+        """
+        response = self._sent_request(
+            "POST",
+            f"study/{study_id}/lease",
+            OptunaLease(
+                count=count,
+                lease_seconds=lease_seconds,
+                distributions=_distributions_to_json(distributions),
+            ),
+            OptunaLeasedTrials,
+        )
+        trials = [trial.to_native() for trial in response.trials]
+        for trial in trials:
+            self._asked_trials[trial._trial_id] = trial
+        return copy.deepcopy(trials)
+
+    def tell_trials(
+        self, study_id: int, results: list[OptunaTrialResult]
+    ) -> list[bool]:
+        """Finish a batch of trials, returns per trial whether it was updated"""
+        response = self._sent_request(
+            "POST",
+            f"study/{study_id}/tell",
+            OptunaTell(results=results),
+            OptunaTellResponse,
+        )
+        return response.did_update
+
+    def should_prune(self, study_id: int, trial_id: int) -> bool:
+        """Evaluate the pruner of the study on the orchestrator"""
+        response = self._sent_request(
+            "GET",
+            f"study/{study_id}/trial/{trial_id}/should-prune",
+            None,
+            OptunaShouldPrune,
+        )
+        return response.should_prune
+
     @override
     def set_trial_param(self, trial_id, param_name, param_value_internal, distribution):
-        self._sent_request(
-            "POST",
-            f"trial/{trial_id}/trial-param",
-            OptunaSetParam(
+        self._buffer_write(
+            OptunaWriteParam(
+                trial_id=trial_id,
                 name=param_name,
                 value=param_value_internal,
                 distribution=optuna.distributions.distribution_to_json(distribution),
-            ),
-            None,
+            )
         )
 
     @override
     def set_trial_state_values(self, trial_id, state, values=None):
-        try:
-            result = self._sent_request(
-                "POST",
-                f"trial/{trial_id}",
-                OptunaSetValue(state=state, value=values),
-                OptunaSetValueResponse,
+        # The end of a trial goes out together with its remaining writes
+        with self._write_buffer_lock:
+            self._write_buffer.append(
+                OptunaWriteStateValues(trial_id=trial_id, state=state, values=values)
             )
-            return result.did_update
-        except:  # noqa: E722
-            return False
+            # A finished trial is not an error, it reports that nothing changed
+            return bool(self.flush())
 
     @override
     def set_trial_intermediate_value(self, trial_id, step, intermediate_value):
-        raise NotImplementedError
+        self._buffer_write(
+            OptunaWriteIntermediateValue(
+                trial_id=trial_id, step=step, value=intermediate_value
+            )
+        )
 
     @override
     def set_trial_user_attr(self, trial_id, key, value):
-        raise NotImplementedError
+        self._buffer_write(
+            OptunaWriteAttr(kind="user_attr", trial_id=trial_id, key=key, value=value)
+        )
 
     @override
     def set_trial_system_attr(self, trial_id, key, value):
-        raise NotImplementedError
+        self._buffer_write(
+            OptunaWriteAttr(kind="system_attr", trial_id=trial_id, key=key, value=value)
+        )
 
     @override
     def get_trial(self, trial_id):
+        asked = self._asked_trials.pop(trial_id, None)
+        if asked is not None:
+            return asked
         response = self._sent_request("GET", f"trial/{trial_id}", None, OptunaTrial)
         return response.to_native()
 
     @override
     def get_all_trials(self, study_id, deepcopy=True, states=None):
-        response = self._sent_request(
-            "GET", f"study/{study_id}/trials", None, OptunaGetAllTrials
-        )
-        return [trial.to_native() for trial in response.trials]
+        with self._trials_lock:
+            cache = self._trial_cache.setdefault(study_id, {})
+            prefix = self._finished_prefix.get(study_id, 0)
+            # Trials up to the finished prefix can no longer change
+            watermark = cache[prefix - 1]._trial_id if prefix > 0 else -1
+            response = self._sent_request(
+                "GET",
+                f"study/{study_id}/trials/changes?after_trial_id={watermark}",
+                None,
+                OptunaGetAllTrials,
+            )
+            for trial in response.trials:
+                cache[trial.number] = trial.to_native()
+            while prefix in cache and cache[prefix].state.is_finished():
+                prefix += 1
+            self._finished_prefix[study_id] = prefix
+
+            trials = [
+                trial
+                for _, trial in sorted(cache.items())
+                if states is None or trial.state in states
+            ]
+        return copy.deepcopy(trials) if deepcopy else trials
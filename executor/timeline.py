@@ -0,0 +1,27 @@
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from shared.models.timeline import StorageRoundTrip, TrialTimeline
+
+
+class Timeline:
+    """
+    The time spent per phase of a trial. The first trial of a process also
+    carries the phases that started the process.
+    """
+
+    def __init__(self, phases: dict[str, float] | None = None):
+        self.phases: dict[str, float] = dict(phases or {})
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def to_model(self, round_trips: list[StorageRoundTrip]) -> TrialTimeline:
+        return TrialTimeline(phases=self.phases, round_trips=round_trips)
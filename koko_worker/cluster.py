@@ -1,24 +1,47 @@
 from __future__ import annotations
 
 import asyncio
+import json
+import shlex
+import subprocess
+import time
+from pathlib import Path
 
 import aiohttp
 import aiohttp.client_exceptions
 import aiohttp.http_exceptions
 from loguru import logger
+from optuna.trial import TrialState
 
 from koko_worker.config import WorkerConfig
 from koko_worker.download import DownloadService
-from koko_worker.environment import run_python_file, sync
+from koko_worker.environment import (
+    kill_process_tree,
+    run_python_file,
+    stop_process_tree,
+)
+from koko_worker.environment_cache import EnvironmentCache
 from koko_worker.pinger import Pinger
 from koko_worker.requests import request
+from koko_worker.slot import Slot
+from shared.models.executor import ExecutorStatus
 from shared.models.node import (
     NodeCapabilities,
+    NodeCommand,
     NodeRegistration,
     NodeRegistrationSuccess,
+    NodeStatus,
     PingResult,
+    SlotState,
+)
+from shared.models.optuna import (
+    FAIL_REASON_ATTR,
+    OptunaWriteAttr,
+    OptunaWriteBatch,
+    OptunaWriteBatchResponse,
+    OptunaWriteStateValues,
 )
-from shared.models.study import CodeBaseStudy
+from shared.models.study import CodeBaseStudy, StudyCandidates
 
 
 class ClusterService:
@@ -35,25 +58,38 @@ class ClusterService:
         id: str,
         capabilities: NodeCapabilities,
         download_service: DownloadService,
+        environment_cache: EnvironmentCache,
         uv_executable: str,
+        slot_count: int = 1,
     ):
         self.id = id
         self.capabilities = capabilities
         self._pinger: Pinger | None = None
-        self.current_study: CodeBaseStudy | None = None
+        self.slots = [Slot(index) for index in range(slot_count)]
         self.download_service = download_service
+        self.environment_cache = environment_cache
         self.uv_executable = uv_executable
+        self._prepare_locks: dict[str, asyncio.Lock] = {}
+        self.draining = False
+        """Finish the running trials, then leave the cluster"""
         ClusterService._instance = self
 
+    async def _send_registration(self) -> NodeRegistrationSuccess:
+        return await request(
+            "register",
+            "POST",
+            NodeRegistration(
+                node_id=self.id,
+                capabilities=self.capabilities,
+                slot_count=len(self.slots),
+            ),
+            NodeRegistrationSuccess,
+        )
+
     async def register(self):
         logger.info("registering with orchestrator")
         try:
-            result = await request(
-                "register",
-                "POST",
-                NodeRegistration(node_id=self.id, capabilities=self.capabilities),
-                NodeRegistrationSuccess,
-            )
+            result = await self._send_registration()
         except aiohttp.client_exceptions.ClientConnectionError:
             logger.error("Failed to connect to orchestrator, are the settings correct?")
             exit(-1)
@@ -61,30 +97,94 @@ class ClusterService:
         self.db_url = WorkerConfig.get().orchestrator_url
         self.ping_interval = result.ping_interval
         logger.info("Creating pinger")
-        self._pinger = Pinger(self.ping_interval, self.id)
+        self._pinger = Pinger(
+            self.ping_interval,
+            self.id,
+            self.node_status,
+            self.handle_commands,
+            self.register_again,
+        )
         asyncio.create_task(self._pinger.run())
 
-    async def request_study(self) -> CodeBaseStudy | None:
+    async def register_again(self) -> None:
+        """
+        Register under the same id after the orchestrator evicted the node, so
+        the trials it runs from now on are reclaimed should it go quiet again
+        """
+        result = await self._send_registration()
+        logger.info(f"registered again {result}")
+
+    def node_status(self) -> tuple[NodeStatus, list[SlotState]]:
+        slots = [slot.to_state() for slot in self.slots]
+        busy = any(slot.status != "idle" for slot in slots)
+        return ("busy" if busy else "idle"), slots
+
+    async def request_study(self, slot: Slot) -> CodeBaseStudy | None:
+        wait = WorkerConfig.get().study_request_wait_seconds
+        try:
+            return await request(
+                f"study/request?wait={wait}&node_id={self.id}&slot={slot.index}",
+                "GET",
+                None,
+                CodeBaseStudy,
+            )
+        except aiohttp.client_exceptions.ClientResponseError:
+            return None
+
+    async def handle_commands(self, commands: list[NodeCommand]) -> None:
+        for command in commands:
+            slots = [
+                slot
+                for slot in self.slots
+                if command.slot is None or slot.index == command.slot
+            ]
+            logger.info(f"The orchestrator asked to {command.kind}")
+            if command.kind == "drain":
+                self.draining = True
+                for slot in self.slots:
+                    self.stop_slot(slot)
+            elif command.kind == "stop_after_trial":
+                for slot in slots:
+                    self.stop_slot(slot)
+            elif command.kind == "cancel_trial":
+                for slot in slots:
+                    await self.cancel_trial(slot)
+            elif command.kind == "switch_study":
+                for slot in slots:
+                    slot.next_study_name = command.study_name
+                    self.stop_slot(slot)
+
+    def stop_slot(self, slot: Slot) -> None:
+        """Let the executor of a slot finish its current trial, then exit"""
+        if slot.status == "idle" or slot.stop_requested:
+            return
+        slot.stop_requested = True
+        if slot.process is not None:
+            stop_process_tree(slot.process)
+
+    async def cancel_trial(self, slot: Slot) -> None:
+        if slot.process is None:
+            return
+        await self.kill_executor(
+            slot, self.read_status(slot), "Cancelled by the orchestrator"
+        )
+
+    async def take_switch_study(self, slot: Slot) -> CodeBaseStudy | None:
+        name, slot.next_study_name = slot.next_study_name, None
+        if name is None:
+            return None
         try:
-            return await request("study/request", "GET", None, CodeBaseStudy)
+            study = await request(f"study/{name}", "GET", None, CodeBaseStudy)
         except aiohttp.client_exceptions.ClientResponseError:
             return None
+        return study if study.state == "running" else None
 
     async def main(self):
+        logger.info(f"Running {len(self.slots)} slot(s)")
         try:
-            while True:
-                if self.current_study is None:
-                    logger.info("Checking if a study is available")
-                    study = await self.request_study()
-                    if study is None:
-                        logger.info("No study available, checking again in 15 seconds")
-                        await asyncio.sleep(15)
-                    else:
-                        self.current_study = study
-                # A study is found
-                else:
-                    await self.run_study()
-
+            await asyncio.gather(
+                *(self.run_slot(slot) for slot in self.slots), self.prefetch()
+            )
         except Exception as e:
             logger.error(f"Error occurred {e}")
             raise e
@@ -95,27 +195,208 @@ class ClusterService:
         logger.info("Gracefully shutting down server")
         await self.teardown()
 
-    async def run_study(self) -> None:
-        logger.info(f"Starting study: {self.current_study}")
-        study = self.current_study
-        if not self.download_service.is_study_cached(study.name):
-            logger.info("The study was not yet cached, downloading it now")
-            await self.download_service.download_study(study.name)
-        else:
-            logger.info(f"Found the study cached {self.download_service.studies_dir}")
-        study_dir = self.download_service.studies_dir.joinpath(study.name).absolute()
-        logger.info(f"Synchronizing virtual environment at: {study_dir.as_posix()}")
-        await sync(project_dir=study_dir, uv_executable=self.uv_executable)
-        await run_python_file(
-            project_dir=study_dir,
-            uv_executable=self.uv_executable,
-            python_file="execute",
-            args=f"--objective-file {study.objective_file} --objective-function {study.objective_function} --study-name {study.name} --storage {self.db_url}",
+    async def run_slot(self, slot: Slot) -> None:
+        while not self.draining:
+            study = await self.take_switch_study(slot)
+            if study is None:
+                logger.info(f"[slot {slot.index}] Checking if a study is available")
+                requested_at = time.monotonic()
+                study = await self.request_study(slot)
+            if self.draining:
+                break
+            if study is None:
+                # The long-poll already waited, only back off when it returned early
+                backoff = max(0.0, 15 - (time.monotonic() - requested_at))
+                logger.info(
+                    f"[slot {slot.index}] No study available, checking again in {backoff:.0f} seconds"
+                )
+                await asyncio.sleep(backoff)
+                continue
+
+            slot.assign(study)
+            try:
+                await self.run_study(slot)
+            except subprocess.CalledProcessError as e:
+                # A failing objective should not take the other slots down
+                logger.error(f"[slot {slot.index}] Study {study.name} failed: {e}")
+            finally:
+                slot.release()
+
+    async def prepare_study(self, study: CodeBaseStudy) -> None:
+        # Slots running the same study share its code base
+        lock = self._prepare_locks.setdefault(study.name, asyncio.Lock())
+        async with lock:
+            if not self.download_service.is_study_cached(study):
+                logger.info("The study was not yet cached, downloading it now")
+                await self.download_service.download_study(study)
+            else:
+                logger.info(
+                    f"Found the study cached {self.download_service.studies_dir}"
+                )
+            self.download_service.mark_used(study)
+        await self.download_service.evict(
+            {self.study_dir(slot.study) for slot in self.slots if slot.study}
+            | {self.study_dir(study)}
+        )
+
+    async def request_candidates(self, limit: int) -> list[CodeBaseStudy]:
+        result = await request(
+            f"study/candidates?node_id={self.id}&limit={limit}",
+            "GET",
+            None,
+            StudyCandidates,
         )
-        self.current_study = None
+        return result.studies
+
+    async def prefetch(self) -> None:
+        """
+        Warm the code base and environment of the studies this node is likely to
+        run next, one at a time, so switching studies does not wait on them
+        """
+        config = WorkerConfig.get()
+        if config.prefetch_studies <= 0:
+            return
+        while not self.draining:
+            await asyncio.sleep(config.prefetch_interval_seconds)
+            # Idle slots prepare the study they are handed themselves
+            if all(slot.status == "idle" for slot in self.slots):
+                continue
+            try:
+                for study in await self.request_candidates(config.prefetch_studies):
+                    await self.prepare_study(study)
+                    await self.environment_cache.warm(self.study_dir(study))
+            except Exception as e:
+                logger.warning(f"Prefetching studies failed: {e}")
+
+    def study_dir(self, study: CodeBaseStudy) -> Path:
+        return self.download_service.study_dir(study).absolute()
+
+    def status_file(self, slot: Slot) -> Path:
+        slots_dir = WorkerConfig.get().data_dir.joinpath("slots").absolute()
+        slots_dir.mkdir(parents=True, exist_ok=True)
+        return slots_dir.joinpath(f"slot-{slot.index}.json")
+
+    async def fail_trial(self, trial_id: int, reason: str) -> None:
+        try:
+            await request(
+                "optuna/trials/batch",
+                "POST",
+                OptunaWriteBatch(
+                    writes=[
+                        OptunaWriteAttr(
+                            kind="system_attr",
+                            trial_id=trial_id,
+                            key=FAIL_REASON_ATTR,
+                            value=reason,
+                        ),
+                        OptunaWriteStateValues(
+                            trial_id=trial_id, state=TrialState.FAIL, values=None
+                        ),
+                    ]
+                ),
+                OptunaWriteBatchResponse,
+            )
+        except Exception as e:
+            logger.warning(f"Failed to report trial {trial_id} as failed: {e}")
+
+    def read_status(self, slot: Slot) -> ExecutorStatus | None:
+        status_file = self.status_file(slot)
+        if not status_file.exists():
+            return None
+        return ExecutorStatus.model_validate_json(status_file.read_text())
+
+    async def kill_executor(
+        self, slot: Slot, status: ExecutorStatus | None, reason: str
+    ) -> None:
+        """Kill the executor of a slot and fail the trial it was running"""
+        logger.warning(f"[slot {slot.index}] {reason}, killing the executor")
+        kill_process_tree(slot.process)
+        if status is not None and status.trial_id is not None:
+            await self.fail_trial(status.trial_id, reason)
+
+    async def watch_executor(self, slot: Slot) -> None:
+        """
+        Kill the executor of a slot once its trial runs past the timeout of the
+        study, or once it stops sending heartbeats
+        """
+        config = WorkerConfig.get()
+        trial_timeout = slot.study.trial_timeout_seconds
+        while True:
+            await asyncio.sleep(config.watchdog_interval_seconds)
+            # The executor writes its first status before importing the objective
+            status = self.read_status(slot)
+            if slot.process is None or status is None:
+                continue
+            now = time.time()
+            if (
+                trial_timeout is not None
+                and status.trial_started_at is not None
+                and now - status.trial_started_at > trial_timeout
+            ):
+                reason = f"Trial exceeded the timeout of {trial_timeout} seconds"
+            elif (
+                config.heartbeat_timeout_seconds is not None
+                and now - status.heartbeat_at > config.heartbeat_timeout_seconds
+            ):
+                reason = f"No heartbeat for {now - status.heartbeat_at:.0f} seconds"
+            else:
+                continue
+
+            await self.kill_executor(slot, status, reason)
+            return
+
+    async def run_study(self, slot: Slot) -> None:
+        study = slot.study
+        logger.info(f"[slot {slot.index}] Starting study: {study}")
+        # Traced per process, the executor attaches them to its first trial
+        phases: dict[str, float] = {}
+        started_at = time.perf_counter()
+        await self.prepare_study(study)
+        phases["codebase"] = time.perf_counter() - started_at
+        config = WorkerConfig.get()
+        args = f"--objective-file {study.objective_file} --objective-function {study.objective_function} --study-name {study.name} --storage {self.db_url}"
+        args += f" --n-trials {config.trials_per_process or 0} --node-id {self.id}"
+        if config.process_timeout_seconds is not None:
+            args += f" --timeout {config.process_timeout_seconds}"
+        if study.server_side_sampling:
+            args += " --server-ask"
+        if study.objective_mode == "batch":
+            args += f" --objective-mode batch --lease-size {study.batch_size}"
+            args += f" --lease-seconds {study.lease_seconds}"
+        elif study.lease_size > 1:
+            args += f" --lease-size {study.lease_size}"
+            args += f" --lease-seconds {study.lease_seconds}"
+        status_file = self.status_file(slot)
+        status_file.unlink(missing_ok=True)
+        args += f" --status-file {shlex.quote(status_file.as_posix())}"
+        args += f" --heartbeat-interval {config.heartbeat_interval_seconds}"
+        study_dir = self.study_dir(study)
+        started_at = time.perf_counter()
+        async with self.environment_cache.environment(study_dir) as environment_dir:
+            phases["uv_sync"] = time.perf_counter() - started_at
+            if slot.stop_requested:
+                logger.info(f"[slot {slot.index}] Stopped before the executor started")
+                return
+            worker_phases = json.dumps(phases, separators=(",", ":"))
+            watchdog = asyncio.create_task(self.watch_executor(slot))
+            try:
+                await run_python_file(
+                    project_dir=study_dir,
+                    uv_executable=self.uv_executable,
+                    python_file="execute",
+                    args=f"{args} --worker-phases {shlex.quote(worker_phases)}"
+                    f" --spawned-at {time.time()}",
+                    on_spawn=slot.set_process,
+                    environment_dir=environment_dir,
+                )
+            finally:
+                watchdog.cancel()
 
     async def teardown(self):
         try:
+            for slot in self.slots:
+                if slot.process is not None:
+                    stop_process_tree(slot.process)
             self._pinger.is_running = False
             await request(f"node/{self.id}", "DELETE", None, PingResult)
         except:  # noqa: E722
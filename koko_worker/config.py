@@ -6,12 +6,38 @@ from venv import logger
 
 from pydantic import BaseModel, field_validator
 
+from shared.models.node import NodeCapabilities
+
 _config_instance: WorkerConfig | None = None
 
 
 class WorkerConfig(BaseModel):
     orchestrator_url: str = "http://localhost:8080"
     data_dir: Path = Path("./data_worker")
+    trials_per_process: int | None = None
+    """How many trials a single executor process runs, None means no limit"""
+    process_timeout_seconds: float | None = 300
+    """After this many seconds an executor stops starting new trials"""
+    slots: int | None = None
+    """The number of concurrent executors, derived from the capabilities when None"""
+    cpus_per_slot: int = 1
+    memory_gb_per_slot: float = 1.0
+    max_environment_cache_gb: float | None = 20
+    """Evict the least recently used environments above this size"""
+    max_cached_code_bases: int | None = 20
+    """Evict the least recently used unpacked code bases above this count"""
+    study_request_wait_seconds: float = 30
+    """How long the orchestrator may hold a study request open"""
+    download_extract_workers: int = 4
+    prefetch_studies: int = 2
+    """How many likely next studies to prepare while trials run, 0 disables it"""
+    prefetch_interval_seconds: float = 60
+    heartbeat_interval_seconds: float = 5
+    """How often an executor reports that it is alive"""
+    heartbeat_timeout_seconds: float | None = 120
+    """Kill an executor that has not reported for this long, None disables it"""
+    watchdog_interval_seconds: float = 5
+    """How often the timeouts of the running trials are checked"""
 
     @field_validator("data_dir", mode="before")
     @classmethod
@@ -23,6 +49,13 @@ class WorkerConfig(BaseModel):
             raise ValueError(f"{v} exists but is not a directory.")
         return path
 
+    def slot_count(self, capabilities: NodeCapabilities) -> int:
+        if self.slots is not None:
+            return self.slots
+        by_cpu = capabilities.cpu_count // self.cpus_per_slot
+        by_memory = int(capabilities.memory_gb // self.memory_gb_per_slot)
+        return max(1, min(by_cpu, by_memory))
+
     @staticmethod
     def from_file(config_path: Path | None) -> WorkerConfig:
         if config_path is None:
@@ -1,33 +1,152 @@
+import asyncio
+import os
+import time
 from pathlib import Path
 import shutil
 from loguru import logger
 import zipfile
 
 from koko_worker.requests import request_file
+from shared.models.study import CodeBaseStudy
+
+
+def _extract_members(zip_path: Path, members: list[str], target_dir: Path) -> None:
+    # Every thread gets its own handle, decompression releases the GIL
+    with zipfile.ZipFile(zip_path, "r") as zip:
+        for member in members:
+            zip.extract(member, target_dir)
+
+
+def _flatten_code_base(study_dir: Path) -> None:
+    shutil.rmtree(study_dir.joinpath("__MACOSX"), ignore_errors=True)
+    code_base_dir = [dir for dir in study_dir.iterdir() if dir.is_dir()][0]
+    for item in code_base_dir.iterdir():
+        shutil.move(item, study_dir)
+    shutil.rmtree(code_base_dir)
+
+
+def _clear_except(directory: Path, keep: Path) -> None:
+    for item in directory.iterdir():
+        if item == keep:
+            continue
+        if item.is_dir():
+            shutil.rmtree(item)
+        else:
+            item.unlink()
+
+
+async def extract_zip_parallel(zip_path: Path, target_dir: Path, workers: int) -> None:
+    with zipfile.ZipFile(zip_path, "r") as zip:
+        infos = zip.infolist()
+    size = sum(info.file_size for info in infos)
+    logger.info(f"Inflating zip [{size / 1e6:.2f} MB] with {workers} thread(s)")
+
+    # Directories up front so the threads never race on creating them
+    directories = {target_dir.joinpath(info.filename).parent for info in infos} | {
+        target_dir.joinpath(info.filename) for info in infos if info.is_dir()
+    }
+    for directory in directories:
+        directory.mkdir(parents=True, exist_ok=True)
+
+    # Spread the members over the threads by size, largest first
+    groups: list[list[str]] = [[] for _ in range(workers)]
+    loads = [0] * workers
+    for info in sorted(infos, key=lambda info: info.file_size, reverse=True):
+        if info.is_dir():
+            continue
+        lightest = loads.index(min(loads))
+        groups[lightest].append(info.filename)
+        loads[lightest] += info.file_size
+
+    await asyncio.gather(
+        *(
+            asyncio.to_thread(_extract_members, zip_path, group, target_dir)
+            for group in groups
+            if group
+        )
+    )
 
 
 class DownloadService:
-    def __init__(self, data_dir: Path):
+    def __init__(
+        self,
+        data_dir: Path,
+        extract_workers: int = 4,
+        max_code_bases: int | None = None,
+    ):
         self.studies_dir = data_dir.joinpath('studies')
         self.studies_dir.mkdir(parents=True, exist_ok=True)
-        
-    def is_study_cached(self, name: str) -> bool:
-        return self.studies_dir.joinpath(name).exists()
-    
-    async def download_study(self, name: str) -> None:
-        study_dir = self.studies_dir.joinpath(name)
-        study_dir.mkdir(parents=True, exist_ok=False)
-        file = study_dir.joinpath('data.zip')
-        with open(file, 'wb') as f:
-            await request_file(f"study/{name}/download", "GET",None, f)
+        self.extract_workers = extract_workers
+        self.max_code_bases = max_code_bases
+        """Keep at most this many unpacked code bases, None keeps all of them"""
+
+    def study_dir(self, study: CodeBaseStudy) -> Path:
+        # Code bases are content addressed, a new upload gets a new directory
+        if study.codebase_hash is None:
+            return self.studies_dir.joinpath(study.name)
+        return self.studies_dir.joinpath(study.codebase_hash)
+
+    def is_study_cached(self, study: CodeBaseStudy) -> bool:
+        return self.study_dir(study).exists()
+
+    def mark_used(self, study: CodeBaseStudy) -> None:
+        # The modification time of the code base doubles as last use
+        os.utime(self.study_dir(study))
+
+    async def evict(self, in_use: set[Path]) -> None:
+        """Remove the least recently used code bases above the limit"""
+        if self.max_code_bases is None:
+            return
+
+        # Partial downloads are kept so that they can be resumed
+        code_bases = [
+            directory
+            for directory in self.studies_dir.iterdir()
+            if directory.is_dir()
+            and not directory.name.startswith(".")
+            and not directory.name.endswith(".partial")
+        ]
+        code_bases.sort(key=lambda directory: directory.stat().st_mtime, reverse=True)
+        for code_base_dir in code_bases[self.max_code_bases :]:
+            if code_base_dir.absolute() in in_use:
+                continue
+            logger.info(f"Evicting code base {code_base_dir.name}")
+            # Move it out of the way first so nobody picks it up while deleting
+            trash = code_base_dir.with_name(
+                f".evicted-{code_base_dir.name}-{time.time_ns()}"
+            )
+            code_base_dir.rename(trash)
+            await asyncio.to_thread(shutil.rmtree, trash, True)
+
+    async def download_study(self, study: CodeBaseStudy) -> None:
+        study_dir = self.study_dir(study)
+        # Unpack next to the final location so a failed download is never cached,
+        # the partial zip is kept so the next attempt can resume it
+        partial_dir = study_dir.with_name(f"{study_dir.name}.partial")
+        partial_dir.mkdir(parents=True, exist_ok=True)
+        file = partial_dir.joinpath("data.zip")
+        await asyncio.to_thread(_clear_except, partial_dir, file)
+
+        offset = file.stat().st_size if file.exists() else 0
+        headers = {}
+        if offset > 0:
+            logger.info(f"Resuming download at {offset / 1e6:.2f} MB")
+            headers["Range"] = f"bytes={offset}-"
+            if study.codebase_hash is not None:
+                # Start over when the code base changed since the partial download
+                headers["If-Range"] = f'"{study.codebase_hash}"'
+
+        with open(file, "ab") as f:
+            await request_file(
+                f"study/{study.name}/download", "GET", None, f, headers=headers
+            )
             logger.info("Finished downloading")
-            
-        with zipfile.ZipFile(file, 'r') as zip:
-            logger.info("Inflating zip")
-            zip.extractall(study_dir)
-            shutil.rmtree(study_dir.joinpath("__MACOSX"))
-            code_base_dir = [dir for dir in study_dir.iterdir() if dir.is_dir()][0]
-            for item in code_base_dir.iterdir():
-                shutil.move(item, study_dir)
-            shutil.rmtree(code_base_dir)
-            logger.info("Finished inflating")
\ No newline at end of file
+
+        try:
+            await extract_zip_parallel(file, partial_dir, self.extract_workers)
+        except zipfile.BadZipFile:
+            file.unlink()
+            raise
+        await asyncio.to_thread(_flatten_code_base, partial_dir)
+        logger.info("Finished inflating")
+        partial_dir.rename(study_dir)
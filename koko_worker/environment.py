@@ -1,9 +1,12 @@
 """Prepare the environment for uv execution"""
 
 import asyncio
+import os
+import signal
 import subprocess
 import sys
 from pathlib import Path
+from typing import Callable
 
 
 # Process both stdout and stderr
@@ -18,12 +21,28 @@ async def read_stream(stream: asyncio.StreamReader):
         sys.stdout.flush()
 
 
-async def sync(project_dir: Path, uv_executable: Path):
+def _uv_env(environment_dir: Path | None) -> dict[str, str]:
+    if environment_dir is None:
+        return {"VIRTUAL_ENV": ".venv", "PYTHONUNBUFFERED": "1"}
+    return {
+        "VIRTUAL_ENV": environment_dir.as_posix(),
+        "UV_PROJECT_ENVIRONMENT": environment_dir.as_posix(),
+        "PYTHONUNBUFFERED": "1",
+    }
+
+
+async def sync(
+    project_dir: Path,
+    uv_executable: Path,
+    environment_dir: Path | None = None,
+    low_priority: bool = False,
+):
+    nice = "nice -n 19 " if low_priority and os.name != "nt" else ""
     process = await asyncio.create_subprocess_shell(
-        f"rm -rf .venv && {uv_executable} sync --no-install-workspace",
+        f"{nice}{uv_executable} sync --no-install-workspace",
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
-        env={"VIRTUAL_ENV": ".venv", "PYTHONUNBUFFERED": "1"},
+        env=_uv_env(environment_dir),
         cwd=project_dir.as_posix(),
     )
 
@@ -36,20 +55,52 @@ async def sync(project_dir: Path, uv_executable: Path):
     if returncode != 0:
         raise subprocess.CalledProcessError(
             returncode=returncode,
-            cmd=f"{uv_executable} sync --frozen",
+            cmd=f"{uv_executable} sync --no-install-workspace",
         )
 
 
+def signal_process_tree(process: asyncio.subprocess.Process, sig: int) -> None:
+    """Send a signal to a process started by `run_python_file` and its children"""
+    if process.returncode is not None:
+        return
+    try:
+        if os.name == "nt":
+            process.send_signal(sig)
+        else:
+            os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def stop_process_tree(process: asyncio.subprocess.Process) -> None:
+    """Ask a resident executor to stop after its current trial"""
+    signal_process_tree(process, signal.SIGTERM)
+
+
+def kill_process_tree(process: asyncio.subprocess.Process) -> None:
+    """Stop an executor right away, whatever its objective is doing"""
+    signal_process_tree(process, getattr(signal, "SIGKILL", signal.SIGTERM))
+
+
 async def run_python_file(
-    project_dir: Path, uv_executable: Path, python_file: Path, args: str = ""
+    project_dir: Path,
+    uv_executable: Path,
+    python_file: Path,
+    args: str = "",
+    on_spawn: Callable[[asyncio.subprocess.Process], None] | None = None,
+    environment_dir: Path | None = None,
 ):
     process = await asyncio.create_subprocess_shell(
         f"{uv_executable} run --no-sync {python_file} {args}",
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
-        env={"VIRTUAL_ENV": ".venv", "PYTHONUNBUFFERED": "1"},
+        env=_uv_env(environment_dir),
         cwd=project_dir,
+        # Own process group so signals reach the interpreter behind `uv run`
+        start_new_session=os.name != "nt",
     )
+    if on_spawn is not None:
+        on_spawn(process)
 
     # Create tasks for reading both stdout and stderr
     await asyncio.gather(read_stream(process.stdout), read_stream(process.stderr))
@@ -0,0 +1,123 @@
+"""Virtual environments shared between studies with identical lockfiles"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import shutil
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator
+
+from loguru import logger
+
+from koko_worker.environment import sync
+
+# Every file that decides what ends up in the environment
+ENVIRONMENT_FILES = ["pyproject.toml", "uv.lock", ".python-version"]
+READY_MARKER = ".kodu-environment.json"
+
+
+def environment_key(project_dir: Path) -> str:
+    digest = hashlib.sha256()
+    for name in ENVIRONMENT_FILES:
+        path = project_dir.joinpath(name)
+        digest.update(name.encode())
+        if path.exists():
+            digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def _directory_size(path: Path) -> int:
+    return sum(
+        file.stat().st_size
+        for file in path.rglob("*")
+        if file.is_file() and not file.is_symlink()
+    )
+
+
+class EnvironmentCache:
+    def __init__(
+        self, data_dir: Path, uv_executable: str, max_size_gb: float | None = None
+    ):
+        self.environments_dir = data_dir.joinpath("environments")
+        self.environments_dir.mkdir(parents=True, exist_ok=True)
+        self.uv_executable = uv_executable
+        self.max_size_bytes = (
+            int(max_size_gb * 1024**3) if max_size_gb is not None else None
+        )
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._in_use: Counter[str] = Counter()
+
+    async def _ensure(self, project_dir: Path, low_priority: bool) -> str:
+        key = environment_key(project_dir)
+        environment_dir = self.environments_dir.joinpath(key)
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            marker = environment_dir.joinpath(READY_MARKER)
+            if marker.exists():
+                logger.info(f"Reusing environment {key[:12]} for {project_dir}")
+            else:
+                logger.info(f"Building environment {key[:12]} for {project_dir}")
+                # A half built environment from an interrupted sync
+                shutil.rmtree(environment_dir, ignore_errors=True)
+                await sync(
+                    project_dir=project_dir,
+                    uv_executable=self.uv_executable,
+                    environment_dir=environment_dir,
+                    low_priority=low_priority,
+                )
+                size = await asyncio.to_thread(_directory_size, environment_dir)
+                marker.write_text(json.dumps({"size_bytes": size}))
+            # The modification time of the marker doubles as last use
+            marker.touch()
+        return key
+
+    @asynccontextmanager
+    async def environment(self, project_dir: Path) -> AsyncIterator[Path]:
+        """
+        Yield a synchronized environment for the project, it is only synced
+        when no environment exists yet for its lockfile
+        """
+        key = await self._ensure(project_dir, low_priority=False)
+        self._in_use[key] += 1
+        try:
+            await self.evict()
+            yield self.environments_dir.joinpath(key)
+        finally:
+            self._in_use[key] -= 1
+
+    async def warm(self, project_dir: Path) -> None:
+        """Build the environment of a project ahead of time, at a low priority"""
+        await self._ensure(project_dir, low_priority=True)
+        await self.evict()
+
+    async def evict(self) -> None:
+        """Remove the least recently used environments until under the size limit"""
+        if self.max_size_bytes is None:
+            return
+
+        environments: list[tuple[float, int, Path]] = []
+        for environment_dir in self.environments_dir.iterdir():
+            marker = environment_dir.joinpath(READY_MARKER)
+            if not marker.exists():
+                continue
+            size = json.loads(marker.read_text())["size_bytes"]
+            environments.append((marker.stat().st_mtime, size, environment_dir))
+
+        total = sum(size for _, size, _ in environments)
+        for _, size, environment_dir in sorted(environments):
+            if total <= self.max_size_bytes:
+                break
+            key = environment_dir.name
+            lock = self._locks.setdefault(key, asyncio.Lock())
+            if self._in_use[key] > 0 or lock.locked():
+                continue
+            logger.info(f"Evicting environment {key[:12]} [{size / 1024**3:.2f} GB]")
+            # Move it out of the way first so nobody picks it up while deleting
+            trash = environment_dir.with_name(f".evicted-{key}-{time.time_ns()}")
+            environment_dir.rename(trash)
+            await asyncio.to_thread(shutil.rmtree, trash, True)
+            total -= size
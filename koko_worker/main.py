@@ -9,6 +9,7 @@ from loguru import logger
 from koko_worker.cluster import ClusterService
 from koko_worker.config import WorkerConfig
 from koko_worker.download import DownloadService
+from koko_worker.environment_cache import EnvironmentCache
 from shared.models.node import NodeCapabilities
 
 
@@ -20,13 +21,22 @@ async def main(config_path=str | None):
         logger.error("uv executable could not be found")
     logger.info(f"Analyzed system: {capabilities}\nuv path: {uv_path}")
 
-    download_service = DownloadService(config.data_dir)
+    download_service = DownloadService(
+        config.data_dir,
+        extract_workers=config.download_extract_workers,
+        max_code_bases=config.max_cached_code_bases,
+    )
+    environment_cache = EnvironmentCache(
+        config.data_dir, uv_path, max_size_gb=config.max_environment_cache_gb
+    )
 
     cluster_service = ClusterService(
         f"{capabilities.hostname}-{uuid4().hex[:4]}",
         capabilities,
         download_service,
+        environment_cache,
         uv_executable=uv_path,
+        slot_count=config.slot_count(capabilities),
     )
     await cluster_service.register()
 
@@ -1,16 +1,36 @@
 import asyncio
+from typing import Awaitable, Callable
 
+import aiohttp
 from loguru import logger
 
 from koko_worker.requests import request
-from shared.models.node import NodePing, NodeStatus, PingResult
+from shared.models.node import (
+    NodeCommand,
+    NodePing,
+    NodeStatus,
+    PingResult,
+    SlotState,
+)
 
 
 class Pinger:
-    def __init__(self, ping_interval: int, node_id: str):
+    def __init__(
+        self,
+        ping_interval: int,
+        node_id: str,
+        node_status: Callable[[], tuple[NodeStatus, list[SlotState]]],
+        on_commands: Callable[[list[NodeCommand]], Awaitable[None]],
+        on_unknown_node: Callable[[], Awaitable[None]],
+    ):
         self.ping_interval = ping_interval
         self.node_id = node_id
-        self.status: NodeStatus = "idle"
+        self.node_status = node_status
+        """Reports the status of the node and the occupancy of its slots"""
+        self.on_commands = on_commands
+        """Carries out the commands the orchestrator answered a ping with"""
+        self.on_unknown_node = on_unknown_node
+        """Registers the node again after the orchestrator evicted it"""
         self.current_trial_id = None
         self.is_running = False
 
@@ -20,16 +40,31 @@ class Pinger:
         while self.is_running:
             try:
                 logger.info("Pinging")
-                await request(
+                status, slots = self.node_status()
+                result = await request(
                     "ping",
                     "POST",
                     data=NodePing(
                         node_id=self.node_id,
-                        status=self.status,
+                        status=status,
                         current_trial_id=self.current_trial_id,
+                        slots=slots,
                     ),
                     result_type=PingResult,
                 )
+                if len(result.commands) > 0:
+                    await self.on_commands(result.commands)
+            except aiohttp.ClientResponseError as e:
+                if e.status != 404:
+                    logger.warning(f"An error occurred when pinging {e}")
+                else:
+                    # Evicted after missing pings, its running trials were
+                    # reclaimed and the trials it starts from now on need an owner
+                    logger.warning("The orchestrator no longer knows this node")
+                    try:
+                        await self.on_unknown_node()
+                    except Exception as e:
+                        logger.warning(f"Registering the node again failed {e}")
             except Exception as e:
                 logger.warning(f"An error occurred when pinging {e}")
             await asyncio.sleep(self.ping_interval)
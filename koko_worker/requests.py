@@ -1,3 +1,4 @@
+import asyncio
 from typing import IO, Literal, Type, TypeVar
 
 import aiohttp
@@ -40,35 +41,65 @@ async def request(
     return result_type.model_validate(await result.json())
 
 
+DOWNLOAD_WRITE_SIZE = 1024 * 1024
+
+
+def _truncate(output_file: IO) -> None:
+    output_file.seek(0)
+    output_file.truncate()
+
+
 async def request_file(
-    uri: str, method: HTTPMethod, data: BaseModel | None, output_file: IO
-) -> None:
+    uri: str,
+    method: HTTPMethod,
+    data: BaseModel | None,
+    output_file: IO,
+    headers: dict[str, str] | None = None,
+) -> int:
+    """
+    Stream a response body into `output_file` and return the status code.
+
+    Disk writes happen off the event loop. A 206 response is appended to
+    whatever the file holds, a 200 response replaces it.
+    """
     config = WorkerConfig.get()
     url = f"{config.orchestrator_url}/{uri}"
 
     async with aiohttp.ClientSession() as session:
         if method == "GET":
-            result = await session.get(url)
+            result = await session.get(url, headers=headers)
         elif method == "PUT":
             result = await session.put(
                 url,
                 json=data.model_dump(),
-                headers={"content-type": "application/json"},
+                headers={"content-type": "application/json", **(headers or {})},
             )
 
         elif method == "POST":
             result = await session.post(
                 url,
                 json=data.model_dump(),
-                headers={"content-type": "application/json"},
+                headers={"content-type": "application/json", **(headers or {})},
             )
         elif method == "DELETE":
-            result = await session.get(url)
+            result = await session.get(url, headers=headers)
         else:
             raise ValueError(f"Unsupported HTTP method: {method}")
 
+        if result.status in (304, 416):
+            # Not modified, or the requested range is past the end of the file
+            return result.status
         result.raise_for_status()
+        if result.status == 200:
+            await asyncio.to_thread(_truncate, output_file)
 
-        # Write the response content to the output file
-        async for chunk in result.content.iter_chunked(8192):
-            output_file.write(chunk)
+        # Write the response content to the output file in large blocks
+        pending = bytearray()
+        async for chunk in result.content.iter_chunked(64 * 1024):
+            pending += chunk
+            if len(pending) >= DOWNLOAD_WRITE_SIZE:
+                await asyncio.to_thread(output_file.write, bytes(pending))
+                pending.clear()
+        if pending:
+            await asyncio.to_thread(output_file.write, bytes(pending))
+        return result.status
@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+
+from shared.models.node import SlotState, SlotStatus
+from shared.models.study import CodeBaseStudy
+
+
+@dataclass
+class Slot:
+    """One executor process the worker can run concurrently with others"""
+
+    index: int
+    status: SlotStatus = "idle"
+    study: CodeBaseStudy | None = None
+    process: asyncio.subprocess.Process | None = None
+    stop_requested: bool = False
+    """The executor was asked to stop after its current trial"""
+    next_study_name: str | None = None
+    """The study the orchestrator asked this slot to switch to"""
+
+    def assign(self, study: CodeBaseStudy) -> None:
+        self.study = study
+        self.status = "preparing"
+
+    def release(self) -> None:
+        self.study = None
+        self.process = None
+        self.status = "idle"
+        self.stop_requested = False
+
+    def set_process(self, process: asyncio.subprocess.Process) -> None:
+        self.process = process
+        self.status = "running"
+
+    def to_state(self) -> SlotState:
+        return SlotState(
+            index=self.index,
+            status=self.status,
+            study_name=self.study.name if self.study is not None else None,
+        )
@@ -0,0 +1,12 @@
+from pydantic import BaseModel
+
+
+class ExecutorStatus(BaseModel):
+    """Written by an executor to a file its worker watches"""
+
+    heartbeat_at: float
+    """The unix time of the last heartbeat"""
+    trial_id: int | None = None
+    """The trial being evaluated, None between trials"""
+    trial_number: int | None = None
+    trial_started_at: float | None = None
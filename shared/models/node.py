@@ -40,6 +40,7 @@ class NodeCapabilities(BaseModel):
 class NodeRegistration(BaseModel):
     node_id: str
     capabilities: NodeCapabilities
+    slot_count: int = 1
 
 
 class NodeRegistrationSuccess(BaseModel):
@@ -47,7 +48,15 @@ class NodeRegistrationSuccess(BaseModel):
     ping_interval: int
 
 
-type NodeStatus = Literal["idle"]
+type NodeStatus = Literal["idle"] | Literal["busy"]
+
+type SlotStatus = Literal["idle"] | Literal["preparing"] | Literal["running"]
+
+
+class SlotState(BaseModel):
+    index: int
+    status: SlotStatus = "idle"
+    study_name: str | None = None
 
 
 class Node(BaseModel):
@@ -56,7 +65,8 @@ class Node(BaseModel):
     capabilities: NodeCapabilities
     status: NodeStatus = "idle"
     current_study: None = None
-    current_trial: None = None
+    current_trial: int | None = None
+    slots: list[SlotState] = []
     logs: list[str] = []
 
 
@@ -64,13 +74,36 @@ class NodePing(BaseModel):
     node_id: str
     current_trial_id: int | None
     status: NodeStatus
+    slots: list[SlotState] = []
+
+
+NODE_ID_HEADER = "x-kodu-node"
+"""Identifies the node an executor runs on in its requests to the orchestrator"""
 
 
 type PingResultStatus = Literal["ok"] | Literal["invalid"]
 
 
+type NodeCommandKind = (
+    Literal["stop_after_trial"]
+    | Literal["cancel_trial"]
+    | Literal["switch_study"]
+    | Literal["drain"]
+)
+
+
+class NodeCommand(BaseModel):
+    kind: NodeCommandKind
+    slot: int | None = None
+    """The slot the command is meant for, None means every slot of the node"""
+    study_name: str | None = None
+    """The study to run next, for switch_study"""
+
+
 class PingResult(BaseModel):
     status: PingResultStatus
+    commands: list[NodeCommand] = []
+    """Applied by the node in order"""
 
 
 class LogUpdate(BaseModel):
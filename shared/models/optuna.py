@@ -1,12 +1,16 @@
 from __future__ import annotations
 
 import datetime
-from typing import Any, Sequence
+from typing import Annotated, Any, Literal, Sequence
 
 import optuna
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 from shared.models.study import StudyDirection
+from shared.models.timeline import TrialTimeline
+
+FAIL_REASON_ATTR = "kodu:fail_reason"
+"""System attr explaining why the platform, not the objective, failed a trial"""
 
 
 class OptunaStudyIdFromName(BaseModel):
@@ -132,3 +136,114 @@ class OptunaSetParam(BaseModel):
     name: str
     value: float
     distribution: str
+
+
+class OptunaSetIntermediateValue(BaseModel):
+    step: int
+    value: float
+
+
+class OptunaShouldPrune(BaseModel):
+    should_prune: bool
+
+
+class OptunaAsk(BaseModel):
+    distributions: dict[str, str] | None = None
+    """The search space to sample, inferred from finished trials when omitted"""
+
+
+class OptunaWriteParam(BaseModel):
+    kind: Literal["param"] = "param"
+    trial_id: int
+    name: str
+    value: float
+    distribution: str
+
+
+class OptunaWriteIntermediateValue(BaseModel):
+    kind: Literal["intermediate_value"] = "intermediate_value"
+    trial_id: int
+    step: int
+    value: float
+
+
+class OptunaWriteAttr(BaseModel):
+    kind: Literal["user_attr"] | Literal["system_attr"]
+    trial_id: int
+    key: str
+    value: Any
+
+
+class OptunaWriteStateValues(BaseModel):
+    kind: Literal["state_values"] = "state_values"
+    trial_id: int
+    state: optuna.trial.TrialState
+    values: Sequence[float] | None
+
+
+class OptunaWriteTimeline(BaseModel):
+    kind: Literal["timeline"] = "timeline"
+    trial_id: int
+    timeline: TrialTimeline
+
+
+OptunaTrialWrite = Annotated[
+    OptunaWriteParam
+    | OptunaWriteIntermediateValue
+    | OptunaWriteAttr
+    | OptunaWriteStateValues
+    | OptunaWriteTimeline,
+    Field(discriminator="kind"),
+]
+
+
+class OptunaWriteBatch(BaseModel):
+    writes: list[OptunaTrialWrite]
+    """Applied in order"""
+
+
+class OptunaRejectedWrite(BaseModel):
+    index: int
+    """The position of the write in the batch"""
+    detail: str
+
+
+class OptunaWriteBatchResponse(BaseModel):
+    did_update: bool | None = None
+    """The result of the last state write in the batch, if any"""
+    rejected: list[OptunaRejectedWrite] = []
+    """Writes refused by the storage, the writes after them were still applied"""
+    stopped_at: int | None = None
+    """Set when the batch failed midway, this write and the ones after it were
+    not applied"""
+    error: str | None = None
+    """Why the batch stopped, if it did"""
+
+
+class OptunaLease(BaseModel):
+    count: int = Field(ge=1, le=1000)
+    lease_seconds: float = Field(gt=0)
+    """Trials that are not told within this time go back to the study"""
+    distributions: dict[str, str] | None = None
+    """The search space to sample, inferred from finished trials when omitted"""
+
+
+class OptunaLeasedTrials(BaseModel):
+    trials: list[OptunaTrial]
+    expires_at: float
+    """Unix time, as seen by the orchestrator"""
+
+
+class OptunaTrialResult(BaseModel):
+    trial_id: int
+    state: optuna.trial.TrialState
+    values: Sequence[float] | None
+
+
+class OptunaTell(BaseModel):
+    results: list[OptunaTrialResult]
+
+
+class OptunaTellResponse(BaseModel):
+    did_update: list[bool]
+    """Per result, false when the trial was already finished, e.g. by expiry"""
@@ -1,16 +1,47 @@
 import datetime
 from typing import Literal
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 type StudyDirection = Literal["minimize"] | Literal["maximize"]
 
+type SamplerName = (
+    Literal["tpe"] | Literal["random"] | Literal["cmaes"] | Literal["qmc"]
+)
+
+type ObjectiveMode = Literal["single"] | Literal["batch"]
+"""A batch objective evaluates many trials in one call, see `executor.batch`"""
+
+type PrunerName = (
+    Literal["median"]
+    | Literal["hyperband"]
+    | Literal["successive_halving"]
+    | Literal["nop"]
+)
+
+
+class StudyScheduling(BaseModel):
+    priority: float = 1.0
+    """The relative share of workers the study gets compared to other studies"""
+    max_trials: int | None = None
+    max_concurrency: int | None = None
+    """The maximum number of worker slots running the study at the same time"""
+    min_cpu_count: int | None = None
+    min_memory_gb: float | None = None
+
 
 class CreateStudy(BaseModel):
     name: str
     direction: StudyDirection = "minimize"
     objective_file: str
     objective_function: str
+    sampler: SamplerName = "tpe"
+    server_side_sampling: bool = False
+    pruner: PrunerName = "median"
+    scheduling: StudyScheduling = StudyScheduling()
+    trial_timeout_seconds: float | None = None
+    lease_size: int = Field(default=1, ge=1, le=1000)
+    lease_seconds: float = Field(default=300, gt=0)
 
 
 type StudyState = Literal["paused"] | Literal["running"]
@@ -23,3 +54,25 @@ class CodeBaseStudy(BaseModel):
     objective_function: str
     state: StudyState = "paused"
     created_at: datetime.datetime
+    sampler: SamplerName = "tpe"
+    server_side_sampling: bool = False
+    """Let the orchestrator sample the parameters of a new trial"""
+    pruner: PrunerName = "median"
+    codebase_hash: str | None = None
+    """The sha256 of the uploaded code base zip, also its download ETag"""
+    scheduling: StudyScheduling = StudyScheduling()
+    trial_timeout_seconds: float | None = None
+    """Workers kill a trial that runs longer and report it as failed"""
+    lease_size: int = Field(default=1, ge=1, le=1000)
+    """Executors ask and tell this many trials per request, for short objectives"""
+    lease_seconds: float = Field(default=300, gt=0)
+    """Leased trials that are not told in time go back to the study"""
+    objective_mode: ObjectiveMode = "single"
+    """As declared in the kodu-optim.json of the code base, never set by clients"""
+    batch_size: int = 32
+    """The number of trials per call of a batch objective, from kodu-optim.json"""
+
+
+class StudyCandidates(BaseModel):
+    studies: list[CodeBaseStudy]
+    """The studies a node is most likely to be handed next, the likeliest first"""
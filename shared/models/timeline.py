@@ -0,0 +1,38 @@
+from pydantic import BaseModel
+
+
+class StorageRoundTrip(BaseModel):
+    operation: str
+    """The HTTP method and path of the request, with ids replaced by `{id}`"""
+    seconds: float
+
+
+class TrialTimeline(BaseModel):
+    phases: dict[str, float]
+    """Seconds spent per phase in the order they ran"""
+    round_trips: list[StorageRoundTrip] = []
+    """Every request the executor made to the orchestrator during the phases"""
+
+
+def percentile(ordered: list[float], fraction: float) -> float:
+    """Nearest rank percentile, `ordered` has to be sorted and not empty"""
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+class PhaseSummary(BaseModel):
+    count: int
+    total_seconds: float
+    mean_seconds: float
+    p50_seconds: float
+    p95_seconds: float
+
+
+class StudyTimelineSummary(BaseModel):
+    trials: int
+    """The number of trials that reported a timeline"""
+    phases: dict[str, PhaseSummary]
+    round_trips: dict[str, PhaseSummary]
+    """Per storage operation"""
+    objective_fraction: float
+    """The share of the traced time that was spent in the objective"""